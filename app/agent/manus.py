@@ -1,18 +1,46 @@
+import functools
+from typing import Dict, List, Optional, Tuple, Union
+
 from pydantic import Field
-import os
-from typing import Optional, Dict, List, Union
 
 from app.agent.toolcall import ToolCallAgent
-from app.prompt.manus import NEXT_STEP_PROMPT, SYSTEM_PROMPT
-from app.tool import Terminate, ToolCollection
-from app.tool.browser_use_tool import BrowserUseTool
-from app.tool.file_saver import FileSaver
-from app.tool.google_search import GoogleSearch
-from app.tool.python_execute import PythonExecute
-from app.schema import AIProvider, ConversationManager, ConversationThread, Memory, AgentState
-from app.model_io import ModelIO
-from app.llm_factory import LLMFactory
 from app.logger import logger
+from app.model_io import DEFAULT_PROVIDER, ModelIO, resolve_provider
+from app.prompt.manus import NEXT_STEP_PROMPT, SYSTEM_PROMPT
+from app.schema import AgentState, AIProvider, ConversationManager
+from app.tool import BaseTool, FetchToolResult, Terminate, ToolCollection
+
+
+@functools.lru_cache(maxsize=1)
+def _shared_stateless_tools() -> Tuple[BaseTool, ...]:
+    """
+    ステートレスなツールを初回利用時に一度だけ生成し、全エージェントで共有する
+    重い依存を持つモジュールはManusのインポート時ではなくここで読み込む
+    """
+    from app.tool.file_saver import FileSaver
+    from app.tool.google_search import GoogleSearch
+    from app.tool.python_execute import PythonExecute
+
+    return (PythonExecute(), GoogleSearch(), FileSaver(), Terminate())
+
+
+def _build_tool_collection() -> ToolCollection:
+    """
+    共有のステートレスなツールと、エージェントごとに状態を持つツールからコレクションを構築
+    ブラウザセッションや退避したツール結果はエージェント間で共有しない
+    """
+    # Playwrightを読み込むブラウザツールはエージェント生成時まで遅延インポート
+    from app.tool.browser_use_tool import BrowserUseTool
+
+    python_execute, google_search, file_saver, terminate = _shared_stateless_tools()
+    return ToolCollection(
+        python_execute,
+        google_search,
+        BrowserUseTool(),
+        file_saver,
+        FetchToolResult(),
+        terminate,
+    )
 
 
 class Manus(ToolCallAgent):
@@ -33,27 +61,39 @@ class Manus(ToolCallAgent):
     next_step_prompt: str = NEXT_STEP_PROMPT
 
     # Add general-purpose tools to the tool collection
-    available_tools: ToolCollection = Field(
-        default_factory=lambda: ToolCollection(
-            PythonExecute(), GoogleSearch(), BrowserUseTool(), FileSaver(), Terminate()
-        )
-    )
+    available_tools: ToolCollection = Field(default_factory=_build_tool_collection)
 
     def __init__(self, conversation_manager: Optional[ConversationManager] = None):
         super().__init__()
         self.state = AgentState.IDLE
-        
+
         # 会話スレッド管理
         self.conversation_manager = conversation_manager or ConversationManager()
         self.current_thread = self.conversation_manager.ensure_current_thread()
-        
-        # デフォルトのAIプロバイダー
-        self.default_provider = AIProvider(os.getenv("AI_PROVIDER", "openai").lower())
-        
+
+        # デフォルトのAIプロバイダー（起動時に解決済みの値を使用）
+        self.default_provider = DEFAULT_PROVIDER
+
         # スレッドのプロバイダーが設定されていない場合は設定
         if self.current_thread and not self.current_thread.provider:
             self.current_thread.provider = self.default_provider
 
+        # プロンプトキャッシュを効かせるため、システムプロンプトは起動時に固定する
+        self._static_system_prompt = self.system_prompt
+
+    def reload_provider_config(self) -> AIProvider:
+        """
+        環境変数AI_PROVIDERを読み直してデフォルトのプロバイダーを更新
+        """
+        self.default_provider = resolve_provider()
+        return self.default_provider
+
+    def get_system_prompt(self) -> str:
+        """
+        ターンをまたいで変化しない静的なシステムプロンプトを取得
+        """
+        return self._static_system_prompt
+
     async def start(self):
         """エージェントを起動"""
         self.state = AgentState.RUNNING
@@ -79,24 +119,13 @@ class Manus(ToolCallAgent):
             current_thread = self.conversation_manager.ensure_current_thread()
             if not current_thread.provider:
                 current_thread.provider = self.default_provider
-            
-            # ユーザークエリをスレッドに追加
-            current_thread.add_user_message(query)
-            
-            # コンテキスト制限をチェック
-            context_info = current_thread.check_context_limit()
-            if not context_info["is_within_limit"]:
-                warning_message = (
-                    f"⚠️ コンテキストウィンドウの制限（{context_info['max_tokens']}トークン）を超えています。"
-                    f"現在のトークン数: {context_info['total_tokens']}トークン\n\n"
-                    f"会話を新しいスレッドで開始することをお勧めします。"
-                )
-                current_thread.add_assistant_message(warning_message)
-                return warning_message
-            
+
+            # ユーザークエリの追加とコンテキスト制限のチェックはLLM側で行う
+            # ここで追加すると履歴に同じメッセージが二重に積まれ、プレフィックスが崩れる
+
             # システムプロンプト取得
             system_prompt = self.get_system_prompt()
-            
+
             # AI応答を生成
             response = await ModelIO.process_conversation_thread(
                 thread=current_thread,
@@ -104,37 +133,38 @@ class Manus(ToolCallAgent):
                 system_prompt=system_prompt,
                 provider=current_thread.provider,
                 stream=False,
-                temperature=0.7
+                temperature=0.7,
             )
-            
+
             return response
-        
+
         except Exception as e:
             error_message = f"エラーが発生しました: {str(e)}"
             logger.error(error_message)
-            
+
             # エラーメッセージをスレッドに追加
             current_thread = self.conversation_manager.ensure_current_thread()
             current_thread.add_assistant_message(error_message)
-            
+
             return error_message
 
-    def create_new_thread(self, title: Optional[str] = None, provider: Optional[AIProvider] = None) -> str:
+    def create_new_thread(
+        self, title: Optional[str] = None, provider: Optional[AIProvider] = None
+    ) -> str:
         """
         新しい会話スレッドを作成
         """
         # プロバイダーが指定されていない場合はデフォルトを使用
         provider = provider or self.default_provider
-        
+
         # 新しいスレッドを作成
         new_thread = self.conversation_manager.create_thread(
-            provider=provider,
-            title=title or "New Conversation"
+            provider=provider, title=title or "New Conversation"
         )
-        
+
         # 現在のスレッドを更新
         self.current_thread = new_thread
-        
+
         return new_thread.id
 
     def get_thread_context_info(self, thread_id: Optional[str] = None) -> Dict:
@@ -149,6 +179,24 @@ class Manus(ToolCallAgent):
         """
         return self.conversation_manager.list_threads()
 
+    async def get_all_threads_info_async(self) -> List[Dict[str, Union[str, int]]]:
+        """
+        すべてのスレッド情報をコンテキスト使用量とともに取得
+        トークン数は各メモリに累積されているため、イベントループ上でそのまま計算する
+        （スレッドプールで実行するとメモリやトークン数のメモを複数スレッドから同時に更新してしまう）
+        """
+        threads = list(self.conversation_manager.threads.values())
+        context_infos = [thread.check_context_limit() for thread in threads]
+        return [
+            {
+                **self.conversation_manager.get_thread_info(thread),
+                "total_tokens": context_info["total_tokens"],
+                "max_tokens": context_info["max_tokens"],
+                "is_within_limit": context_info["is_within_limit"],
+            }
+            for thread, context_info in zip(threads, context_infos)
+        ]
+
     def switch_thread(self, thread_id: str) -> bool:
         """
         指定されたスレッドに切り替え
@@ -1,14 +1,15 @@
-import json
+import uuid
 from typing import Any, List, Literal
 
+import orjson
 from pydantic import Field
 
 from app.agent.react import ReActAgent
+from app.llm_factory import LLMFactory
 from app.logger import logger
 from app.prompt.toolcall import NEXT_STEP_PROMPT, SYSTEM_PROMPT
 from app.schema import AgentState, Message, ToolCall
-from app.tool import CreateChatCompletion, Terminate, ToolCollection
-from app.llm_factory import LLMFactory
+from app.tool import CreateChatCompletion, FetchToolResult, Terminate, ToolCollection
 
 
 TOOL_CALL_REQUIRED = "Tool calls required but none provided"
@@ -33,15 +34,23 @@ class ToolCallAgent(ReActAgent):
 
     max_steps: int = 30
 
+    # Tool results longer than this are moved out of the history once they age out
+    observation_mask_chars: int = 2000
+    # Number of most recent steps whose tool results are always kept verbatim
+    observation_keep_steps: int = 3
+
     async def think(self) -> bool:
         """Process current state and decide next actions using tools"""
+        # Page out stale, large tool results before building the next prompt
+        self.mask_old_tool_results()
+
         if self.next_step_prompt:
             user_msg = Message.user_message(self.next_step_prompt)
-            self.messages += [user_msg]
+            self.memory.add_message(user_msg)
 
         # Get LLM from factory based on environment setting
         llm = LLMFactory.get_llm()
-        
+
         # Get response with tool options
         response = await llm.ask_tool(
             messages=self.messages,
@@ -138,7 +147,7 @@ class ToolCallAgent(ReActAgent):
 
         try:
             # Parse arguments
-            args = json.loads(command.function.arguments or "{}")
+            args = orjson.loads(command.function.arguments or "{}")
 
             # Execute the tool
             logger.info(f"🔧 Activating tool: '{name}'...")
@@ -155,7 +164,7 @@ class ToolCallAgent(ReActAgent):
             await self._handle_special_tool(name=name, result=result)
 
             return observation
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             error_msg = f"Error parsing arguments for {name}: Invalid JSON format"
             logger.error(
                 f"📝 Oops! The arguments for '{name}' don't make sense - invalid JSON, arguments:{command.function.arguments}"
@@ -166,6 +175,50 @@ class ToolCallAgent(ReActAgent):
             logger.error(error_msg)
             return f"Error: {error_msg}"
 
+    def mask_old_tool_results(self) -> int:
+        """Replace large tool results older than the recency window with references.
+
+        The full content is kept in the FetchToolResult tool's store so the model
+        can page it back in on demand. Masking is skipped when the agent does not
+        expose that tool. Returns the number of messages masked.
+        """
+        fetch_tool = self.available_tools.get_tool("fetch_tool_result")
+        if not isinstance(fetch_tool, FetchToolResult):
+            return 0
+
+        messages = list(self.memory.messages)
+        steps_seen = 0
+        masked = 0
+        for index in range(len(messages) - 1, -1, -1):
+            msg = messages[index]
+            if msg.role == "assistant":
+                steps_seen += 1
+                continue
+            if (
+                msg.role != "tool"
+                or steps_seen <= self.observation_keep_steps
+                or len(msg.content) <= self.observation_mask_chars
+                or msg.content.startswith("[tool_result_ref:")
+            ):
+                continue
+
+            ref = uuid.uuid4().hex[:12]
+            fetch_tool.store[ref] = msg.content
+            summary = msg.content[:200].replace("\n", " ")
+            messages[index] = msg.model_copy(
+                update={
+                    "content": f"[tool_result_ref:{ref} size={len(msg.content)} summary={summary}]"
+                }
+            )
+            masked += 1
+
+        if masked:
+            self.memory.set_messages(messages)
+            logger.info(
+                f"📦 Paged out {masked} stale tool result(s) from {self.name}'s history"
+            )
+        return masked
+
     async def _handle_special_tool(self, name: str, result: Any, **kwargs):
         """Handle special tool execution and state changes"""
         if not self._is_special_tool(name):
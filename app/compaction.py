@@ -0,0 +1,89 @@
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from app.logger import logger
+from app.schema import ConversationThread, Message
+
+
+# 古いターンを要約する際のシステムプロンプト
+SUMMARY_PROMPT = (
+    "Summarize the following conversation in at most 500 tokens. "
+    "Preserve decisions made, facts established, and any open TODO state."
+)
+
+# コンテキスト使用率がこの割合を超えたら古いターンを要約して圧縮する（全プロバイダ共通）
+COMPACTION_THRESHOLD = float(os.getenv("LLM_COMPACTION_THRESHOLD", "0.6"))
+# 圧縮時にそのまま残す直近のメッセージ数
+COMPACTION_KEEP_RECENT = int(os.getenv("LLM_COMPACTION_KEEP_RECENT", "20"))
+# 圧縮時に常に残す先頭のメッセージ数（ユーザーの最初の目標）
+COMPACTION_KEEP_FIRST = 1
+
+
+def format_transcript(messages: List[Message]) -> str:
+    """
+    要約モデルに渡すための会話ログを作成
+    """
+    return "\n\n".join(f"[{message.role}] {message.content}" for message in messages)
+
+
+async def compact_if_needed(
+    llm: Any,
+    thread: ConversationThread,
+    pending_messages: List[Message],
+    summarize: Optional[Callable[[List[Message]], Awaitable[str]]] = None,
+    force: bool = False,
+    reserve_tokens: int = 0,
+) -> Dict:
+    """
+    未追加のメッセージを含めたコンテキスト使用率が閾値を超えていれば、
+    古いターンを要約してスレッドを圧縮し、最新のコンテキスト情報を返す
+    要約にはsummarizeを使い、省略した場合はllm.askで要約する
+    force=Trueの場合は使用率に関わらず圧縮する（システムプロンプト込みで超過した場合の再試行用）
+    要約後もコンテキスト制限（reserve_tokensを差し引いた値）を超える場合は、
+    最初のメッセージと要約を残して古いターンから削除する
+    """
+    context_info = thread.check_context_limit(pending_messages=pending_messages)
+    if (
+        not force
+        and context_info["total_tokens"]
+        <= context_info["max_tokens"] * COMPACTION_THRESHOLD
+    ):
+        return context_info
+
+    if summarize is None:
+
+        async def summarize(messages: List[Message]) -> str:
+            return await llm.ask(
+                messages=[Message.user_message(format_transcript(messages))],
+                system_msgs=[Message.system_message(SUMMARY_PROMPT)],
+                temperature=0.0,
+            )
+
+    original_count = len(thread.memory.messages)
+    try:
+        compacted = await thread.compact(
+            summarize,
+            keep_recent=COMPACTION_KEEP_RECENT,
+            keep_first_n=COMPACTION_KEEP_FIRST,
+        )
+    except Exception as e:
+        logger.warning(f"会話の要約に失敗したため、要約せずに続行します: {str(e)}")
+        compacted = False
+
+    if compacted:
+        logger.info(
+            f"会話スレッドを圧縮しました: {original_count}件 -> {len(thread.memory.messages)}件"
+        )
+        context_info = thread.check_context_limit(pending_messages=pending_messages)
+
+    # 要約後も制限を超える場合はスライディングウィンドウで古いターンを削除
+    limit = context_info["max_tokens"] - reserve_tokens
+    if context_info["total_tokens"] > limit:
+        pending_tokens = context_info["total_tokens"] - thread.memory.get_token_total()
+        dropped = thread.drop_oldest_turns(
+            limit - pending_tokens, keep_first_n=COMPACTION_KEEP_FIRST
+        )
+        if dropped:
+            logger.info(f"コンテキストに収めるため古いメッセージを{dropped}件削除しました")
+            context_info = thread.check_context_limit(pending_messages=pending_messages)
+    return context_info
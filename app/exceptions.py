@@ -12,9 +12,11 @@ class ContextWindowExceededError(Exception):
         self.message = message
         self.total_tokens = total_tokens
         self.max_tokens = max_tokens
-        
+
     def __str__(self):
-        return f"{self.message} (使用トークン: {self.total_tokens}, 最大トークン: {self.max_tokens})"
+        return (
+            f"{self.message} (使用トークン: {self.total_tokens}, 最大トークン: {self.max_tokens})"
+        )
 
 
 class TokenCountingError(Exception):
@@ -23,8 +25,20 @@ class TokenCountingError(Exception):
     def __init__(self, message, provider=None):
         self.message = message
         self.provider = provider
-        
+
     def __str__(self):
         if self.provider:
             return f"{self.message} (プロバイダ: {self.provider})"
         return self.message
+
+
+class RetryableAPIError(Exception):
+    """レート制限（429）やサーバーエラー（5xx）など、再試行で回復し得るAPIエラー"""
+
+    def __init__(self, message, status=None, retry_after=None):
+        self.message = message
+        self.status = status
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return self.message
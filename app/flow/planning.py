@@ -1,7 +1,7 @@
-import json
 import time
 from typing import Dict, List, Optional, Union
 
+import orjson
 from pydantic import Field
 
 from app.agent.base import BaseAgent
@@ -15,7 +15,7 @@ from app.tool import PlanningTool
 class PlanningFlow(BaseFlow):
     """A flow that manages planning and execution of tasks using agents."""
 
-    llm: LLM = Field(default_factory=lambda: LLM())
+    llm: LLM = Field(default_factory=LLM.get)
     planning_tool: PlanningTool = Field(default_factory=PlanningTool)
     executor_keys: List[str] = Field(default_factory=list)
     active_plan_id: str = Field(default_factory=lambda: f"plan_{int(time.time())}")
@@ -133,8 +133,8 @@ class PlanningFlow(BaseFlow):
                     args = tool_call.function.arguments
                     if isinstance(args, str):
                         try:
-                            args = json.loads(args)
-                        except json.JSONDecodeError:
+                            args = orjson.loads(args)
+                        except orjson.JSONDecodeError:
                             logger.error(f"Failed to parse tool arguments: {args}")
                             continue
 
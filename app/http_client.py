@@ -0,0 +1,25 @@
+import importlib.util
+
+import httpx
+
+
+# h2がインストールされている場合のみHTTP/2で接続する（未インストールならHTTP/1.1）
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+def create_async_client(
+    timeout: float = 120, max_connections: int = 64
+) -> httpx.AsyncClient:
+    """
+    プロセス全体で共有するHTTPクライアントを生成
+    HTTP/2が使える場合は同時リクエストを一本の接続に多重化し、TCP/TLSハンドシェイクを減らす
+    """
+    return httpx.AsyncClient(
+        http2=HTTP2_AVAILABLE,
+        timeout=httpx.Timeout(timeout),
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=75,
+        ),
+    )
@@ -0,0 +1,53 @@
+import asyncio
+from typing import Optional
+
+import httpx
+from tenacity import (
+    RetryCallState,
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+from app.exceptions import RetryableAPIError
+
+
+# 再試行で回復し得るHTTPステータス（レート制限とサーバー側の一時的なエラー）
+RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+_backoff = wait_random_exponential(min=1, max=60)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Retry-Afterヘッダー（秒数）を解釈（未指定や日付形式の場合はNone）
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+def _wait_retry_after(retry_state: RetryCallState) -> float:
+    """
+    指数バックオフの待機時間と、サーバーが指定したRetry-Afterのうち長い方だけ待機
+    """
+    backoff = _backoff(retry_state)
+    error = retry_state.outcome.exception() if retry_state.outcome else None
+    if isinstance(error, RetryableAPIError) and error.retry_after is not None:
+        return max(error.retry_after, backoff)
+    return backoff
+
+
+# 429/5xxと接続エラーのみリトライし、認証エラーや400系は即座に失敗させる
+http_api_retry = retry(
+    wait=_wait_retry_after,
+    stop=stop_after_attempt(6),
+    retry=retry_if_exception_type(
+        (RetryableAPIError, httpx.TransportError, asyncio.TimeoutError)
+    ),
+    reraise=True,
+)
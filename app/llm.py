@@ -1,22 +1,93 @@
-from typing import Dict, List, Literal, Optional, Union, Any
+import asyncio
+import hashlib
+import io
 import os
-import json
-import aiohttp
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Union
 
+import orjson
 from openai import (
-    APIError,
-    AsyncAzureOpenAI,
+    APIConnectionError,
+    APITimeoutError,
     AsyncOpenAI,
-    AuthenticationError,
-    OpenAIError,
+    InternalServerError,
     RateLimitError,
 )
-from tenacity import retry, stop_after_attempt, wait_random_exponential
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
 
-from app.config import LLMSettings, config
-from app.logger import logger  # Assuming a logger is set up in your app
-from app.schema import Message, AIProvider, ConversationThread
+from app.compaction import SUMMARY_PROMPT, compact_if_needed, format_transcript
 from app.exceptions import ContextWindowExceededError
+from app.http_client import create_async_client
+from app.logger import logger  # Assuming a logger is set up in your app
+from app.schema import (
+    AIProvider,
+    ConversationThread,
+    Message,
+    ToolResponse,
+    to_api_messages,
+)
+from app.stream_writer import StreamWriter, stream_echo_enabled
+from app.token_counter import TokenCounter
+
+
+# 一時的なエラーのみリトライし、認証エラーや400系は即座に失敗させる
+_RETRYABLE_ERRORS = (
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+    RateLimitError,
+)
+
+_api_retry = retry(
+    wait=wait_random_exponential(min=1, max=60),
+    stop=stop_after_attempt(6),
+    retry=retry_if_exception_type(_RETRYABLE_ERRORS),
+    reraise=True,
+)
+
+
+# OpenAI互換のChat Completions APIを持つプロバイダごとの環境変数と既定値
+_PROVIDER_SETTINGS: Dict[AIProvider, Dict[str, str]] = {
+    AIProvider.OPENAI: {
+        "env_prefix": "OPENAI",
+        "model_env": "OPENAI_MODEL",
+        "api_url": "https://api.openai.com",
+        "endpoint": "v1/chat/completions",
+        "model": "o3-mini-2025-01-31",
+        "summary_model": "gpt-4o-mini",
+    },
+    AIProvider.GROQ_LLAMA: {
+        "env_prefix": "GROQ",
+        "model_env": "GROQ_LLAMA_MODEL",
+        "api_url": "https://api.groq.com",
+        "endpoint": "openai/v1/chat/completions",
+        "model": "llama-3.3-70b-versatile",
+        "summary_model": "llama-3.1-8b-instant",
+    },
+    AIProvider.GROQ_DEEPSEEK: {
+        "env_prefix": "GROQ",
+        "model_env": "GROQ_DEEPSEEK_MODEL",
+        "api_url": "https://api.groq.com",
+        "endpoint": "openai/v1/chat/completions",
+        "model": "deepseek-r1-distill-llama-70b",
+        "summary_model": "llama-3.1-8b-instant",
+    },
+}
+
+
+def _copy_tool_response(response: ToolResponse) -> ToolResponse:
+    """
+    ツール呼び出しのレスポンスを複製する（SDKのツール呼び出しオブジェクトも深くコピーする）
+    """
+    return ToolResponse(
+        response.content,
+        [tool_call.model_copy(deep=True) for tool_call in response.tool_calls],
+    )
 
 
 class LLM:
@@ -24,64 +95,227 @@ class LLM:
     LLMの共通インタフェースを定義する基底クラス
     特定のLLMサービスごとに実装を行うためのテンプレート
     デフォルトではOpenAIのAPIを使用
+    インスタンスはプロバイダごとにLLM.get()で共有し、接続プールもプロバイダごとに分離する
     """
-    _instance = None
-    
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super().__new__(cls)
-            cls._instance._initialized = False
-        return cls._instance
-    
-    def __init__(self):
-        if self._initialized:
-            return
-            
+
+    _registry: Dict[AIProvider, "LLM"] = {}
+
+    @classmethod
+    def get(cls, provider: Union[AIProvider, str] = AIProvider.OPENAI) -> "LLM":
+        """
+        プロバイダごとに共有されるLLMインスタンスを取得します
+        """
+        provider = AIProvider(provider)
+        llm = cls._registry.get(provider)
+        if llm is None:
+            llm = cls._registry[provider] = cls(provider)
+        return llm
+
+    def __init__(self, provider: Union[AIProvider, str] = AIProvider.OPENAI):
+        provider = AIProvider(provider)
+        settings = _PROVIDER_SETTINGS.get(provider)
+        if settings is None:
+            raise ValueError(f"LLMはOpenAI互換APIを持つプロバイダのみ対応しています: {provider.value}")
+
+        # トークン数の計算に使用するプロバイダ名
+        self.provider = provider
+        self._provider_name = provider.value
+        prefix = settings["env_prefix"]
+
         # 環境変数から設定を読み込み
-        self.api_key = os.getenv("OPENAI_API_KEY", "")
-        self.api_url = os.getenv("OPENAI_API_URL", "https://api.openai.com")
-        self.model = os.getenv("OPENAI_MODEL", "o3-mini-2025-01-31")
-        self.endpoint = os.getenv("OPENAI_ENDPOINT", "v1/chat/completions")
-        
+        self.api_key = os.getenv(f"{prefix}_API_KEY", "")
+        self.api_url = os.getenv(f"{prefix}_API_URL", settings["api_url"])
+        self.model = os.getenv(settings["model_env"], settings["model"])
+        self.endpoint = os.getenv(f"{prefix}_ENDPOINT", settings["endpoint"])
+
         # コンテキストウィンドウサイズを取得
-        self.max_context_tokens = int(os.getenv("OPENAI_MAX_CONTEXT_TOKENS", "200000"))
-        self.max_output_tokens = int(os.getenv("OPENAI_MAX_OUTPUT_TOKENS", "4096"))
-        
+        self.max_context_tokens = int(
+            os.getenv(f"{prefix}_MAX_CONTEXT_TOKENS", "200000")
+        )
+        self.max_output_tokens = int(os.getenv(f"{prefix}_MAX_OUTPUT_TOKENS", "4096"))
+
+        # コンテキスト圧縮時に古いターンの要約に使う軽量モデル（閾値はapp.compactionで共通）
+        self.summary_model = os.getenv(
+            f"{prefix}_SUMMARY_MODEL", settings["summary_model"]
+        )
+
+        # ストリーミング時にトークンを標準出力へエコーするか
+        self.stream_echo = stream_echo_enabled()
+
+        # HTTPクライアントのタイムアウト（秒）
+        self.request_timeout = float(os.getenv(f"{prefix}_REQUEST_TIMEOUT", "600"))
+
         if not self.api_key:
-            raise ValueError("OPENAI_API_KEY環境変数が設定されていません")
-        
-        self._initialized = True
-    
+            raise ValueError(f"{prefix}_API_KEY環境変数が設定されていません")
+
+        # SDKクライアントは一度だけ生成し、接続プールを使い回す（閉じられた場合は次回利用時に再生成）
+        self._base_url = f"{self.api_url}/{self.endpoint}".removesuffix(
+            "/chat/completions"
+        )
+        self._sdk_client: Optional[AsyncOpenAI] = None
+
+        # 整形済みシステムメッセージ（プロンプトキャッシュ用の静的プレフィックス）
+        self._system_prefix_key: tuple = ()
+        self._system_prefix: List[Dict] = []
+        self._system_prefix_tokens = 0
+
+        # リクエストごとに変化しない共通パラメータ
+        self._base_params = {
+            "model": self.model,
+            "max_tokens": self.max_output_tokens,
+        }
+
+        # 決定的なリクエスト（temperature=0）の完全一致レスポンスキャッシュ
+        self.response_cache_size = int(
+            os.getenv(f"{prefix}_RESPONSE_CACHE_SIZE", "1024")
+        )
+        self._response_cache: OrderedDict[str, Any] = OrderedDict()
+        self._response_cache_lock = asyncio.Lock()
+
+    @property
+    def _client(self) -> AsyncOpenAI:
+        """
+        SDKクライアントを取得します（未生成または閉じられている場合は生成）
+        インスタンスは複数のエージェントから共有されるため、aclose後も利用を続けられるようにする
+        """
+        if self._sdk_client is None or self._sdk_client.is_closed():
+            # リトライはtenacityで行うため、SDK側のリトライは無効化
+            self._sdk_client = AsyncOpenAI(
+                api_key=self.api_key,
+                base_url=self._base_url,
+                max_retries=0,
+                timeout=self.request_timeout,
+                http_client=create_async_client(timeout=self.request_timeout),
+            )
+        return self._sdk_client
+
+    async def aclose(self) -> None:
+        """
+        HTTPクライアントを閉じます（プロセス終了時にLLMFactory.aclose_allから呼ばれる）
+        """
+        if self._sdk_client is not None:
+            await self._sdk_client.close()
+            self._sdk_client = None
+
+    @classmethod
+    async def aclose_all(cls) -> None:
+        """
+        共有されている全プロバイダのインスタンスのHTTPクライアントを閉じます
+        """
+        for llm in list(cls._registry.values()):
+            await llm.aclose()
+
+    def invalidate_cache(self) -> None:
+        """
+        レスポンスキャッシュをクリアします
+        """
+        self._response_cache.clear()
+
+    def _cache_key(self, *parts: Any) -> str:
+        """
+        モデル名とリクエスト内容からキャッシュキーを生成します
+        """
+        raw = orjson.dumps(
+            (self.model, *parts), option=orjson.OPT_SORT_KEYS, default=str
+        )
+        return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+    async def _get_cached(self, key: str) -> Optional[Any]:
+        """
+        キャッシュ済みのレスポンスを取得します
+        """
+        async with self._response_cache_lock:
+            cached = self._response_cache.get(key)
+            if cached is not None:
+                self._response_cache.move_to_end(key)
+            return cached
+
+    async def _set_cached(self, key: str, value: Any) -> None:
+        """
+        レスポンスをキャッシュに保存し、上限を超えた古いエントリを破棄します
+        """
+        if self.response_cache_size <= 0:
+            return
+        async with self._response_cache_lock:
+            self._response_cache[key] = value
+            self._response_cache.move_to_end(key)
+            if len(self._response_cache) > self.response_cache_size:
+                self._response_cache.popitem(last=False)
+
     @staticmethod
-    def format_messages(messages: List[Union[dict, Message]]) -> List[Dict]:
+    def format_messages(
+        messages: Union[List[Union[dict, Message]], ConversationThread]
+    ) -> List[Dict]:
         """
         メッセージをLLM API形式に変換します
+        会話スレッドが渡された場合は、追加時に整形済みのメッセージをそのまま使用します
+        戻り値は入力リストそのものの場合があるため、呼び出し側で変更しないでください
         """
-        formatted_messages = []
-        
-        for message in messages:
-            if isinstance(message, dict):
-                formatted_messages.append({
-                    "role": message.get("role", "user"),
-                    "content": message.get("content", "")
-                })
-            elif isinstance(message, Message):
-                formatted_messages.append({
-                    "role": message.role,
-                    "content": message.content
-                })
-            else:
-                raise TypeError(f"Unsupported message type: {type(message)}")
-                
-        return formatted_messages
-        
-    @retry(
-        wait=wait_random_exponential(min=1, max=60),
-        stop=stop_after_attempt(6),
-    )
+        if isinstance(messages, ConversationThread):
+            return messages.memory.get_formatted_messages()
+
+        # すでにAPI形式（roleとcontentのみのdict）のリストは再構築せずにそのまま返す
+        if all(
+            type(m) is dict and len(m) == 2 and "role" in m and "content" in m
+            for m in messages
+        ):
+            return messages
+
+        return to_api_messages(messages)
+
+    def _format_system_messages(
+        self, system_msgs: Optional[List[Union[dict, Message]]]
+    ) -> List[Dict]:
+        """
+        システムメッセージを整形します
+        内容が前回と同じ場合は整形済みのリストをそのまま返し、プレフィックスを固定します
+        """
+        key = tuple(
+            sys_msg.get("content", "") if isinstance(sys_msg, dict) else sys_msg.content
+            for sys_msg in system_msgs or []
+            if isinstance(sys_msg, dict)
+            or (isinstance(sys_msg, Message) and sys_msg.role == "system")
+        )
+        if key != self._system_prefix_key:
+            self._system_prefix_key = key
+            self._system_prefix = [
+                {"role": "system", "content": content} for content in key
+            ]
+            self._system_prefix_tokens = sum(
+                TokenCounter.count_tokens_for_message(message, self._provider_name)
+                for message in self._system_prefix
+            )
+        return self._system_prefix
+
+    def _count_prompt_tokens(
+        self, messages: Union[List[Union[dict, Message]], ConversationThread]
+    ) -> Optional[int]:
+        """
+        スレッドの場合は累積トークン数と直前に整形したシステムプレフィックスのトークン数から合計を求めます
+        リストの場合はNoneを返し、全件カウントにフォールバックします
+        """
+        if not isinstance(messages, ConversationThread):
+            return None
+        return messages.memory.get_token_total() + self._system_prefix_tokens
+
+    def build_messages(
+        self,
+        messages: Union[List[Union[dict, Message]], ConversationThread],
+        system_msgs: Optional[List[Union[dict, Message]]] = None,
+    ) -> List[Dict]:
+        """
+        プロバイダのプレフィックスキャッシュが効くよう、静的なプレフィックス（システムメッセージ）の後に
+        コミット済みの履歴を挿入順のまま連結します
+        """
+        return [
+            *self._format_system_messages(system_msgs),
+            *self.format_messages(messages),
+        ]
+
+    @_api_retry
     async def ask(
         self,
-        messages: List[Union[dict, Message]],
+        messages: Union[List[Union[dict, Message]], ConversationThread],
         system_msgs: Optional[List[Union[dict, Message]]] = None,
         stream: bool = False,
         temperature: Optional[float] = None,
@@ -90,87 +324,59 @@ class LLM:
         LLM APIにリクエストを送信し、レスポンスを取得します
         """
         try:
-            # メッセージの準備
-            formatted_messages = []
-            
-            # システムメッセージが提供されている場合、最初に追加
-            if system_msgs and len(system_msgs) > 0:
-                for sys_msg in system_msgs:
-                    if isinstance(sys_msg, dict):
-                        formatted_messages.append({
-                            "role": "system",
-                            "content": sys_msg.get("content", "")
-                        })
-                    elif isinstance(sys_msg, Message):
-                        if sys_msg.role == "system":
-                            formatted_messages.append({
-                                "role": "system",
-                                "content": sys_msg.content
-                            })
-            
-            # ユーザーおよびアシスタントメッセージを追加
-            formatted_messages.extend(self.format_messages(messages))
-            
+            # 静的なプレフィックスの後に履歴を連結
+            formatted_messages = self.build_messages(messages, system_msgs)
+
             # トークン数をチェック
-            self.check_token_limit(formatted_messages)
-                
-            # ペイロード構築
-            payload = {
-                "model": self.model,
-                "messages": formatted_messages,
-                "max_tokens": self.max_output_tokens,
-                "temperature": 0.0 if temperature is None else temperature,
-                "stream": stream
-            }
-            
+            self.check_token_limit(
+                formatted_messages, total_tokens=self._count_prompt_tokens(messages)
+            )
+
+            temperature = 0.0 if temperature is None else temperature
+
+            # 決定的なリクエストはキャッシュを参照
+            cache_key = None
+            if not stream and temperature == 0:
+                cache_key = self._cache_key(temperature, formatted_messages)
+                cached = await self._get_cached(cache_key)
+                if cached is not None:
+                    return cached
+
             # リクエスト送信
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{self.api_url}/{self.endpoint}",
-                    json=payload,
-                    headers={
-                        "Content-Type": "application/json", 
-                        "Authorization": f"Bearer {self.api_key}"
-                    }
-                ) as response:
-                    if response.status != 200:
-                        error_text = await response.text()
-                        logger.error(f"API error: {response.status} - {error_text}")
-                        raise ValueError(f"API request failed with status {response.status}: {error_text}")
-                    
-                    if stream:
-                        # ストリーミングレスポンスの処理
-                        collected_content = []
-                        async for line in response.content:
-                            if line:
-                                line_text = line.decode("utf-8").strip()
-                                if line_text.startswith("data: "):
-                                    data = line_text[6:]
-                                    if data != "[DONE]":
-                                        try:
-                                            chunk = json.loads(data)
-                                            delta = chunk["choices"][0]["delta"]
-                                            if "content" in delta:
-                                                content = delta["content"]
-                                                collected_content.append(content)
-                                                print(content, end="", flush=True)
-                                        except json.JSONDecodeError:
-                                            pass
-                        
-                        print()  # 最後に改行
-                        return "".join(collected_content)
-                    else:
-                        # 通常レスポンスの処理
-                        result = await response.json()
-                        return result["choices"][0]["message"]["content"]
-                    
+            response = await self._client.chat.completions.create(
+                **self._base_params,
+                messages=formatted_messages,
+                temperature=temperature,
+                stream=stream,
+            )
+
+            if stream:
+                # ストリーミングレスポンスの処理
+                collected_content = io.StringIO()
+                writer = StreamWriter(enabled=self.stream_echo)
+                async for chunk in response:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        content = chunk.choices[0].delta.content
+                        collected_content.write(content)
+                        writer.write(content)
+
+                writer.close()  # 残りを書き出して改行
+                return collected_content.getvalue()
+
+            # 通常レスポンスの処理
+            content = response.choices[0].message.content
+            if cache_key is not None and content is not None:
+                await self._set_cached(cache_key, content)
+            return content
+
         except Exception as e:
             logger.error(f"Error in API request: {str(e)}")
             raise
-            
+
+    @_api_retry
     async def ask_tool(
         self,
-        messages: List[Union[dict, Message]],
+        messages: Union[List[Union[dict, Message]], ConversationThread],
         system_msgs: Optional[List[Union[dict, Message]]] = None,
         tools: Optional[List[dict]] = None,
         tool_choice: str = "auto",
@@ -180,101 +386,67 @@ class LLM:
         ツール呼び出し対応のリクエストを実行します。
         """
         try:
-            # メッセージの準備
-            formatted_messages = []
-            
-            # システムメッセージが提供されている場合、最初に追加
-            if system_msgs and len(system_msgs) > 0:
-                for sys_msg in system_msgs:
-                    if isinstance(sys_msg, dict):
-                        formatted_messages.append({
-                            "role": "system",
-                            "content": sys_msg.get("content", "")
-                        })
-                    elif isinstance(sys_msg, Message):
-                        if sys_msg.role == "system":
-                            formatted_messages.append({
-                                "role": "system",
-                                "content": sys_msg.content
-                            })
-            
-            # ユーザーおよびアシスタントメッセージを追加
-            formatted_messages.extend(self.format_messages(messages))
-            
+            # 静的なプレフィックスの後に履歴を連結
+            formatted_messages = self.build_messages(messages, system_msgs)
+
             # トークン数をチェック
-            self.check_token_limit(formatted_messages)
-                
-            # ペイロード構築
-            payload = {
-                "model": self.model,
-                "messages": formatted_messages,
-                "max_tokens": self.max_output_tokens,
-                "temperature": 0.0
-            }
-            
-            # ツール情報が提供されている場合、ペイロードに追加
-            if tools:
-                payload["tools"] = tools
-                payload["tool_choice"] = tool_choice
-            
+            self.check_token_limit(
+                formatted_messages, total_tokens=self._count_prompt_tokens(messages)
+            )
+
+            # ツール情報が提供されている場合のみツール指定を付与
+            tool_params = {"tools": tools, "tool_choice": tool_choice} if tools else {}
+
+            # temperature=0固定のため、同一リクエストはキャッシュを参照
+            cache_key = self._cache_key(formatted_messages, tool_params)
+            cached = await self._get_cached(cache_key)
+            if cached is not None:
+                # 呼び出し側での変更がキャッシュに波及しないよう、ヒットごとに複製を返す
+                return _copy_tool_response(cached)
+
             # リクエスト送信
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{self.api_url}/{self.endpoint}",
-                    json=payload,
-                    headers={
-                        "Content-Type": "application/json", 
-                        "Authorization": f"Bearer {self.api_key}"
-                    }
-                ) as response:
-                    if response.status != 200:
-                        error_text = await response.text()
-                        logger.error(f"API error: {response.status} - {error_text}")
-                        raise ValueError(f"API request failed with status {response.status}: {error_text}")
-                    
-                    # レスポンスの解析
-                    result = await response.json()
-                    response_message = result["choices"][0]["message"]
-                    content = response_message.get("content", "")
-                    tool_calls = response_message.get("tool_calls", [])
-                    
-                    # ツール呼び出し情報を含むレスポンスオブジェクトを返す
-                    from types import SimpleNamespace
-                    response = SimpleNamespace()
-                    response.content = content
-                    response.tool_calls = tool_calls
-                    
-                    return response
-                    
+            response = await self._client.chat.completions.create(
+                **self._base_params,
+                messages=formatted_messages,
+                temperature=0.0,
+                **tool_params,
+            )
+
+            # SDKのメッセージはそのまま保持せず、contentとtool_callsのスナップショットを返す
+            message = response.choices[0].message
+            result = ToolResponse(message.content or "", list(message.tool_calls or []))
+            await self._set_cached(cache_key, _copy_tool_response(result))
+            return result
+
         except Exception as e:
             logger.error(f"Error in tool API request: {str(e)}")
             raise
-            
-    def check_token_limit(self, messages: List[Dict]) -> bool:
+
+    def check_token_limit(
+        self, messages: List[Dict], total_tokens: Optional[int] = None
+    ) -> bool:
         """
         メッセージのトークン数がモデルの制限を超えていないか確認します
         超えている場合はエラーを発生させます
+        total_tokensが与えられた場合は再カウントせずにその値を使用します
         """
-        from app.token_counter import TokenCounter
-        
-        # プロバイダ名を取得
-        provider = "openai"
-        
-        # トークン数を計算
-        result = TokenCounter.check_context_limit(messages, provider)
-        
+        # トークン数を計算（制限から十分遠い場合はBPEを使わない見積もりで判定）
+        result = TokenCounter.check_context_limit(
+            messages, self._provider_name, total_tokens=total_tokens, approx=True
+        )
+
         if not result["is_within_limit"]:
             logger.warning(
                 f"トークン数が制限を超えています: {result['total_tokens']} > {result['max_tokens']}"
             )
             raise ContextWindowExceededError(
                 f"メッセージのトークン数がモデルの制限を超えています。会話を新しいスレッドで開始するか、古いメッセージを削除してください。",
-                total_tokens=result['total_tokens'],
-                max_tokens=result['max_tokens']
+                total_tokens=result["total_tokens"],
+                max_tokens=result["max_tokens"],
             )
-        
+
         return True
-        
+
     async def process_conversation_thread(
         self,
         thread: "ConversationThread",
@@ -288,9 +460,13 @@ class LLM:
         """
         # メッセージをスレッドに追加
         thread.add_user_message(user_message)
-        
-        # コンテキスト制限をチェック
-        context_info = thread.check_context_limit()
+
+        # コンテキスト使用率が閾値を超えた場合は古いターンを要約して圧縮
+        context_info = await compact_if_needed(
+            self, thread, [], summarize=self._summarize_messages
+        )
+
+        # 圧縮後もコンテキスト制限を超えている場合
         if not context_info["is_within_limit"]:
             # コンテキスト制限を超えている場合、制限に関する情報をレスポンスとしてアシスタントメッセージを追加
             warning_message = (
@@ -300,22 +476,63 @@ class LLM:
             )
             thread.add_assistant_message(warning_message)
             return warning_message
-        
+
         try:
             # AIモデルに問い合わせ
-            response = await self.ask(
-                messages=thread.memory.messages,
-                system_msgs=system_msgs,
-                stream=stream,
-                temperature=temperature
-            )
-            
+            # スレッドを直接渡し、整形済みの履歴を再利用する
+            try:
+                response = await self.ask(
+                    messages=thread,
+                    system_msgs=system_msgs,
+                    stream=stream,
+                    temperature=temperature,
+                )
+            except ContextWindowExceededError as e:
+                # システムプロンプト込みで超過した場合は圧縮して一度だけ再試行
+                # システムプロンプト分を差し引いた制限に収まるまで古いターンも削除する
+                version = thread.memory.version
+                reserve_tokens = max(
+                    0, e.total_tokens - thread.memory.get_token_total()
+                )
+                await compact_if_needed(
+                    self,
+                    thread,
+                    [],
+                    summarize=self._summarize_messages,
+                    force=True,
+                    reserve_tokens=reserve_tokens,
+                )
+                if thread.memory.version == version:
+                    raise
+                response = await self.ask(
+                    messages=thread,
+                    system_msgs=system_msgs,
+                    stream=stream,
+                    temperature=temperature,
+                )
+
             # レスポンスをスレッドに追加
             thread.add_assistant_message(response)
-            
+
             return response
         except Exception as e:
             error_message = f"エラーが発生しました: {str(e)}"
             logger.error(error_message)
             thread.add_assistant_message(error_message)
             return error_message
+
+    async def _summarize_messages(self, messages: List[Message]) -> str:
+        """
+        メッセージ列を要約用モデルで短い要約に変換します
+        """
+        transcript = format_transcript(messages)
+        response = await self._client.chat.completions.create(
+            model=self.summary_model,
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": transcript},
+            ],
+            max_tokens=500,
+            temperature=0.0,
+        )
+        return response.choices[0].message.content or ""
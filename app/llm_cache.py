@@ -0,0 +1,218 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import orjson
+
+from app.logger import logger
+
+
+class LLMCache:
+    """
+    決定的なLLMリクエスト（temperature=0）のレスポンスをプロセス内に保持するTTL付きLRUキャッシュ
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # キー -> (有効期限, 値)
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+
+    @classmethod
+    def from_env(cls) -> "LLMCache":
+        """
+        環境変数LLM_CACHE_SIZE / LLM_CACHE_TTLから設定を読み込んでキャッシュを生成
+        """
+        return cls(
+            maxsize=int(os.getenv("LLM_CACHE_SIZE", "1024")),
+            ttl=float(os.getenv("LLM_CACHE_TTL", "3600")),
+        )
+
+    @staticmethod
+    def make_key(**parts: Any) -> str:
+        """
+        リクエスト内容（プロバイダ・メッセージ・ツールなど）からキャッシュキーを生成
+        """
+        raw = orjson.dumps(parts, option=orjson.OPT_SORT_KEYS, default=str)
+        return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        キャッシュ済みの値を取得（期限切れの場合は破棄してNone）
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] < time.monotonic():
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            logger.debug(f"LLMキャッシュミス (hits={self.hits}, misses={self.misses})")
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        logger.debug(f"LLMキャッシュヒット (hits={self.hits}, misses={self.misses})")
+        return entry[1]
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        """
+        値を保存し、上限を超えた古いエントリを破棄
+        """
+        if self.maxsize <= 0:
+            return
+        self._entries[key] = (
+            time.monotonic() + (self.ttl if ttl is None else ttl),
+            value,
+        )
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """
+        すべてのエントリを破棄
+        """
+        self._entries.clear()
+
+
+class SemanticCache:
+    """
+    言い換えられた質問にも応答を再利用する意味的キャッシュ
+    直前までの履歴（システムプロンプトを含む）が完全一致するスコープ内で、
+    最後のユーザーメッセージの埋め込みのコサイン類似度が閾値以上のエントリを返す
+    埋め込みモデル（sentence-transformers）は任意の依存で、初回利用時に読み込む
+    モデルの読み込みと埋め込みの計算はイベントループを塞がないようワーカースレッドで実行する
+    """
+
+    def __init__(
+        self,
+        embed: Optional[Callable[[str], Sequence[float]]] = None,
+        threshold: float = 0.92,
+        maxsize: int = 1024,
+        model_name: str = "sentence-transformers/all-MiniLM-L6-v2",
+    ):
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.model_name = model_name
+        self.hits = 0
+        self.misses = 0
+        self._embed = embed
+        self._disabled = False
+        # 複数のワーカースレッドから同時にモデルを読み込まないためのロック
+        self._load_lock = threading.Lock()
+        # スコープ -> (正規化済み埋め込みのリスト, 応答のリスト)
+        self._entries: "OrderedDict[str, Tuple[List[np.ndarray], List[Any]]]" = (
+            OrderedDict()
+        )
+        self._size = 0
+
+    @classmethod
+    def from_env(cls) -> Optional["SemanticCache"]:
+        """
+        環境変数LLM_SEMANTIC_CACHEが有効な場合のみ意味的キャッシュを生成
+        """
+        if os.getenv("LLM_SEMANTIC_CACHE", "false").lower() not in ("1", "true", "yes"):
+            return None
+        return cls(
+            threshold=float(os.getenv("LLM_SEMANTIC_CACHE_THRESHOLD", "0.92")),
+            maxsize=int(os.getenv("LLM_CACHE_SIZE", "1024")),
+            model_name=os.getenv(
+                "LLM_SEMANTIC_CACHE_MODEL", "sentence-transformers/all-MiniLM-L6-v2"
+            ),
+        )
+
+    @staticmethod
+    def split_query(
+        model: str, api_messages: List[Dict[str, Any]]
+    ) -> Optional[Tuple[str, str]]:
+        """
+        API形式のメッセージを(スコープ, 最後のユーザーメッセージ)に分ける
+        最後のメッセージがユーザーのテキストでない場合はNone
+        """
+        if not api_messages:
+            return None
+        last = api_messages[-1]
+        if last.get("role") != "user" or not isinstance(last.get("content"), str):
+            return None
+        return (
+            LLMCache.make_key(model=model, history=api_messages[:-1]),
+            last["content"],
+        )
+
+    def _embed_text(self, text: str) -> Optional[np.ndarray]:
+        """
+        テキストを正規化済みの埋め込みベクトルに変換（埋め込みモデルが使えない場合はNone）
+        モデルの読み込みと推論を伴うため、ワーカースレッドから呼び出す
+        """
+        if self._embed is None:
+            with self._load_lock:
+                if self._disabled:
+                    return None
+                if self._embed is None:
+                    try:
+                        from sentence_transformers import SentenceTransformer
+                    except ImportError:
+                        logger.warning(
+                            "sentence-transformersがインストールされていないため、意味的キャッシュを無効化します"
+                        )
+                        self._disabled = True
+                        return None
+                    self._embed = SentenceTransformer(self.model_name).encode
+        vector = np.asarray(self._embed(text), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    async def _aembed_text(self, text: str) -> Optional[np.ndarray]:
+        """
+        イベントループを塞がないよう、埋め込みの計算をワーカースレッドで実行
+        """
+        if self._disabled:
+            return None
+        return await asyncio.to_thread(self._embed_text, text)
+
+    async def get(self, scope: str, text: str) -> Optional[Any]:
+        """
+        同じスコープ内で最も類似したエントリの応答を取得（類似度が閾値未満ならNone）
+        """
+        entry = self._entries.get(scope)
+        vector = await self._aembed_text(text) if entry else None
+        if vector is not None:
+            vectors, responses = entry
+            similarities = np.stack(vectors) @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.threshold:
+                # 埋め込みの計算中に破棄されている場合があるため、残っている場合のみ更新する
+                if scope in self._entries:
+                    self._entries.move_to_end(scope)
+                self.hits += 1
+                logger.debug(
+                    f"意味的キャッシュヒット (similarity={similarities[best]:.3f}, hits={self.hits}, misses={self.misses})"
+                )
+                return responses[best]
+        self.misses += 1
+        return None
+
+    async def set(self, scope: str, text: str, response: Any) -> None:
+        """
+        応答を保存し、上限を超えた場合は最も古いスコープから破棄
+        """
+        if self.maxsize <= 0:
+            return
+        vector = await self._aembed_text(text)
+        if vector is None:
+            return
+        # 埋め込みの計算中に同じスコープが破棄されている場合があるため、ここで取り直す
+        vectors, responses = self._entries.setdefault(scope, ([], []))
+        vectors.append(vector)
+        responses.append(response)
+        self._entries.move_to_end(scope)
+        self._size += 1
+        while self._size > self.maxsize:
+            _, (old_vectors, _) = self._entries.popitem(last=False)
+            self._size -= len(old_vectors)
@@ -1,269 +1,441 @@
+import asyncio
+import io
 import os
-import json
-from typing import Dict, List, Optional, Union
+import threading
+from typing import Dict, List, Optional, Tuple, Union
+
+import orjson
 from anthropic import AsyncAnthropic
 
-from app.schema import Message, Function, ConversationThread
+from app.compaction import compact_if_needed
 from app.logger import logger
+from app.schema import ConversationThread, Message, ToolResponse, to_api_messages
+from app.stream_writer import StreamWriter
+from app.token_counter import TokenCounter
 
 
 class ClaudeLLM:
     """
     Anthropic ClaudeのLLMインターフェース実装クラス
     """
+
     _instance = None
+    _lock = threading.Lock()
 
     def __new__(cls):
+        # スレッドから同時に呼ばれても一つのインスタンスだけを生成する（ダブルチェックロッキング）
         if cls._instance is None:
-            cls._instance = super().__new__(cls)
-            cls._instance._initialized = False
+            with cls._lock:
+                if cls._instance is None:
+                    instance = super().__new__(cls)
+                    instance._initialized = False
+                    cls._instance = instance
         return cls._instance
 
     def __init__(self):
         if self._initialized:
             return
-            
-        # 環境変数から設定を読み込み
-        self.api_key = os.getenv("CLAUDE_API_KEY", "")
-        
-        if not self.api_key:
-            raise ValueError("CLAUDE_API_KEY環境変数が設定されていません")
-            
-        self.model = os.getenv("CLAUDE_MODEL", "claude-3-7-sonnet-20250219")
-        
-        # コンテキストウィンドウサイズを取得
-        self.max_context_tokens = int(os.getenv("CLAUDE_MAX_CONTEXT_TOKENS", "200000"))
-        self.max_output_tokens = int(os.getenv("CLAUDE_MAX_OUTPUT_TOKENS", "128000"))
-        
-        # Anthropic API Client初期化
-        self.client = AsyncAnthropic(
-            api_key=self.api_key,
+        with self._lock:
+            if self._initialized:
+                return
+
+            # 環境変数から設定を読み込み
+            self.api_key = os.getenv("CLAUDE_API_KEY", "")
+
+            if not self.api_key:
+                raise ValueError("CLAUDE_API_KEY環境変数が設定されていません")
+
+            self.model = os.getenv("CLAUDE_MODEL", "claude-3-7-sonnet-20250219")
+
+            # コンテキストウィンドウサイズを取得
+            self.max_context_tokens = int(
+                os.getenv("CLAUDE_MAX_CONTEXT_TOKENS", "200000")
+            )
+            self.max_output_tokens = int(
+                os.getenv("CLAUDE_MAX_OUTPUT_TOKENS", "128000")
+            )
+
+            # Anthropic API Client初期化
+            self.client = AsyncAnthropic(
+                api_key=self.api_key,
+            )
+
+            # システムプロンプト・ツール定義・会話履歴にプロンプトキャッシュのブレークポイントを付与するか
+            self.prompt_cache = os.getenv("CLAUDE_PROMPT_CACHE", "1").lower() in (
+                "1",
+                "true",
+                "yes",
+            )
+
+            # 同時に送信中のリクエスト数の上限（バースト時のレート制限（429）の連鎖を防ぐ）
+            self._request_semaphore = asyncio.Semaphore(
+                max(1, int(os.getenv("CLAUDE_MAX_CONCURRENCY", "16")))
+            )
+
+            # バッチ処理の完了を待つ最大秒数（既定値はバッチの有効期限と同じ24時間）
+            self.batch_timeout = float(os.getenv("CLAUDE_BATCH_TIMEOUT", "86400"))
+
+            self._initialized = True
+
+    async def aclose(self) -> None:
+        """
+        Anthropicクライアントの接続プールを閉じます
+        """
+        await self.client.close()
+
+    @staticmethod
+    def _extract_system(system_msgs: Optional[List[Union[dict, Message]]]) -> str:
+        """
+        システムメッセージの内容を改行で連結します（中間リストを作らずに一度の走査で処理）
+        """
+        return "\n".join(
+            m.get("content", "") if isinstance(m, dict) else m.content
+            for m in system_msgs or ()
+            if isinstance(m, dict) or (isinstance(m, Message) and m.role == "system")
         )
-        
-        self._initialized = True
-        
+
+    @staticmethod
+    def _split_system(
+        formatted_messages: List[Dict], system_message: str
+    ) -> Tuple[List[Dict], str]:
+        """
+        整形済みメッセージを一度の走査でuser/assistantのメッセージとシステムメッセージに分けます
+        会話中にシステムメッセージが含まれる場合は最後のものをsystem_messageの代わりに使用します
+        """
+        claude_messages = []
+        for msg in formatted_messages:
+            role = msg["role"]
+            if role == "system":
+                system_message = msg["content"]
+            elif role in ("user", "assistant"):
+                # OpenAI形式のtool_callsなどClaudeが受け付けないキーは渡さない
+                claude_messages.append({"role": role, "content": msg["content"]})
+        return claude_messages, system_message
+
+    def _system_param(self, system_message: str):
+        """
+        systemパラメータを構築します
+        プロンプトキャッシュが有効な場合はcache_control付きのテキストブロックにします
+        """
+        if not system_message:
+            return None
+        if not self.prompt_cache:
+            return system_message
+        return [
+            {
+                "type": "text",
+                "text": system_message,
+                "cache_control": {"type": "ephemeral"},
+            }
+        ]
+
+    def _mark_history_cache(self, claude_messages: List[Dict]) -> List[Dict]:
+        """
+        最後のユーザーメッセージにキャッシュのブレークポイントを付与し、それまでの会話履歴を再利用させます
+        """
+        if not self.prompt_cache or len(claude_messages) <= 1:
+            return claude_messages
+        for i in range(len(claude_messages) - 1, -1, -1):
+            message = claude_messages[i]
+            if (
+                message["role"] == "user"
+                and isinstance(message["content"], str)
+                and message["content"]
+            ):
+                claude_messages[i] = {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": message["content"],
+                            "cache_control": {"type": "ephemeral"},
+                        }
+                    ],
+                }
+                break
+        return claude_messages
+
+    @staticmethod
+    def _log_cache_usage(response) -> None:
+        """
+        プロンプトキャッシュのヒット状況をログに出力します
+        """
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+        cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+        cache_creation = getattr(usage, "cache_creation_input_tokens", None) or 0
+        if cache_read or cache_creation:
+            logger.info(
+                f"Claudeプロンプトキャッシュ: read={cache_read} creation={cache_creation} "
+                f"input={getattr(usage, 'input_tokens', 0)}"
+            )
+
     @staticmethod
     def format_messages(messages: List[Union[dict, Message]]) -> List[Dict]:
         """
         メッセージをClaude形式に変換する
         """
-        formatted_messages = []
-        
-        for message in messages:
-            if isinstance(message, dict):
-                formatted_messages.append({
-                    "role": message.get("role", "user"),
-                    "content": message.get("content", "")
-                })
-            elif isinstance(message, Message):
-                formatted_messages.append({
-                    "role": message.role,
-                    "content": message.content
-                })
-            else:
-                raise TypeError(f"Unsupported message type: {type(message)}")
-                
-        return formatted_messages
-        
+        return to_api_messages(messages)
+
     async def ask(
         self,
         messages: List[Union[dict, Message]],
         system_msgs: Optional[List[Union[dict, Message]]] = None,
         stream: bool = False,
         temperature: Optional[float] = None,
+        _skip_token_check: bool = False,
     ) -> str:
         """
         Claude APIに問い合わせ、レスポンスを取得する
+        _skip_token_check: 呼び出し側でコンテキスト制限を確認済みの場合にトークン数の再チェックを省略する（内部用）
         """
         try:
-            # メッセージの準備
-            formatted_messages = []
-            
-            # システムメッセージが提供されている場合、別途保持
-            system_message = ""
-            if system_msgs and len(system_msgs) > 0:
-                system_contents = []
-                for sys_msg in system_msgs:
-                    if isinstance(sys_msg, dict):
-                        system_contents.append(sys_msg.get("content", ""))
-                    elif isinstance(sys_msg, Message):
-                        if sys_msg.role == "system":
-                            system_contents.append(sys_msg.content)
-                system_message = "\n".join(system_contents)
-            
-            # ユーザーおよびアシスタントメッセージを追加
-            formatted_messages.extend(self.format_messages(messages))
-            
-            # トークン数をチェック
-            self.check_token_limit(formatted_messages)
-            
-            # Claude API形式に変換
-            claude_messages = []
-            
-            for msg in formatted_messages:
-                role = msg["role"]
-                content = msg["content"]
-                
-                if role == "user":
-                    claude_messages.append({"role": "user", "content": content})
-                elif role == "assistant":
-                    claude_messages.append({"role": "assistant", "content": content})
-                elif role == "system":
-                    # システムメッセージが複数ある場合、最後のものを使用
-                    system_message = content
-            
+            # システムメッセージは別途保持し、ユーザーおよびアシスタントメッセージを整形
+            system_message = self._extract_system(system_msgs)
+            formatted_messages = self.format_messages(messages)
+
+            # トークン数をチェック（呼び出し側で確認済みの場合は省略）
+            if not _skip_token_check:
+                self.check_token_limit(formatted_messages)
+
+            # Claude API形式に変換（整形済みのdictは作り直さずにそのまま使う）
+            claude_messages, system_message = self._split_system(
+                formatted_messages, system_message
+            )
+
+            claude_messages = self._mark_history_cache(claude_messages)
+
             # レスポンスを取得
             if stream:
-                # ストリーミングレスポンスの処理
-                response_stream = await self.client.messages.create(
-                    model=self.model,
-                    messages=claude_messages,
-                    system=system_message if system_message else None,
-                    temperature=0.6 if temperature is None else temperature,
-                    max_tokens=self.max_output_tokens,
-                    stream=True
-                )
-                
-                collected_content = []
-                async for chunk in response_stream:
-                    if hasattr(chunk, "delta") and chunk.delta.text:
-                        content = chunk.delta.text
-                        collected_content.append(content)
-                        print(content, end="", flush=True)
-                
-                print()  # 最後に改行
-                return "".join(collected_content)
+                # ストリーミングレスポンスの処理（ストリームを読み終えるまで同時実行数の枠を保持）
+                async with self._request_semaphore:
+                    response_stream = await self.client.messages.create(
+                        model=self.model,
+                        messages=claude_messages,
+                        system=self._system_param(system_message),
+                        temperature=0.6 if temperature is None else temperature,
+                        max_tokens=self.max_output_tokens,
+                        stream=True,
+                    )
+
+                    collected_content = io.StringIO()
+                    writer = StreamWriter()
+                    async for event in response_stream:
+                        # テキストの差分イベントだけを型で判別して取り出す
+                        if (
+                            event.type == "content_block_delta"
+                            and event.delta.type == "text_delta"
+                        ):
+                            content = event.delta.text
+                            collected_content.write(content)
+                            writer.write(content)
+
+                writer.close()  # 残りを書き出して改行
+                return collected_content.getvalue()
             else:
                 # 通常レスポンスの処理
-                response = await self.client.messages.create(
-                    model=self.model,
-                    messages=claude_messages,
-                    system=system_message if system_message else None,
-                    temperature=0.6 if temperature is None else temperature,
-                    max_tokens=self.max_output_tokens
-                )
-                
+                async with self._request_semaphore:
+                    response = await self.client.messages.create(
+                        model=self.model,
+                        messages=claude_messages,
+                        system=self._system_param(system_message),
+                        temperature=0.6 if temperature is None else temperature,
+                        max_tokens=self.max_output_tokens,
+                    )
+                self._log_cache_usage(response)
+
                 return response.content[0].text
-                
+
         except Exception as e:
             logger.error(f"Error in Claude API request: {str(e)}")
             raise
-    
+
+    async def ask_batch(
+        self,
+        message_lists: List[List[Union[dict, Message]]],
+        system_msgs: Optional[List[Union[dict, Message]]] = None,
+        temperature: Optional[float] = None,
+        poll_interval: float = 5.0,
+        max_poll_interval: float = 60.0,
+        timeout: Optional[float] = None,
+    ) -> List[str]:
+        """
+        Message Batches APIで複数の独立したリクエストをまとめて処理します
+        レイテンシを問わない一括処理向け（コストが半分になる代わりに結果は非同期で返る）
+        戻り値は入力と同じ順序の応答テキストのリスト
+        timeout秒（省略時は環境変数CLAUDE_BATCH_TIMEOUT）以内に終わらない場合はバッチをキャンセルしてTimeoutErrorを送出する
+        """
+        if not message_lists:
+            return []
+
+        try:
+            system_message = self._extract_system(system_msgs)
+            requests = []
+            for index, messages in enumerate(message_lists):
+                formatted_messages = self.format_messages(messages)
+                self.check_token_limit(formatted_messages)
+                claude_messages, request_system = self._split_system(
+                    formatted_messages, system_message
+                )
+                params = {
+                    "model": self.model,
+                    "messages": claude_messages,
+                    "temperature": 0.6 if temperature is None else temperature,
+                    "max_tokens": self.max_output_tokens,
+                }
+                system_param = self._system_param(request_system)
+                if system_param:
+                    params["system"] = system_param
+                requests.append({"custom_id": f"request-{index}", "params": params})
+
+            batch = await self.client.messages.batches.create(requests=requests)
+            logger.info(f"Claudeバッチを作成しました: {batch.id} ({len(requests)}件)")
+
+            # 処理が終わるまで間隔を広げながらポーリング
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + (
+                self.batch_timeout if timeout is None else timeout
+            )
+            delay = poll_interval
+            while batch.processing_status != "ended":
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    await self._cancel_batch(batch.id)
+                    raise TimeoutError(f"Claudeバッチ {batch.id} が制限時間内に完了しませんでした")
+                await asyncio.sleep(min(delay, remaining))
+                delay = min(delay * 2, max_poll_interval)
+                batch = await self.client.messages.batches.retrieve(batch.id)
+
+            # 結果はcustom_idで入力順に並べ直す
+            responses = [""] * len(requests)
+            async for entry in await self.client.messages.batches.results(batch.id):
+                index = int(entry.custom_id.rsplit("-", 1)[1])
+                if entry.result.type == "succeeded":
+                    responses[index] = "".join(
+                        block.text
+                        for block in entry.result.message.content
+                        if block.type == "text"
+                    )
+                else:
+                    responses[index] = f"エラーが発生しました: {entry.result.type}"
+                    logger.error(
+                        f"Claudeバッチのリクエスト {entry.custom_id} が失敗しました: {entry.result.type}"
+                    )
+            return responses
+
+        except Exception as e:
+            logger.error(f"Error in Claude batch API request: {str(e)}")
+            raise
+
+    async def _cancel_batch(self, batch_id: str) -> None:
+        """
+        バッチをキャンセルします（失敗しても呼び出し元のエラーを優先するため警告のみ）
+        """
+        try:
+            await self.client.messages.batches.cancel(batch_id)
+            logger.warning(f"Claudeバッチをキャンセルしました: {batch_id}")
+        except Exception as e:
+            logger.warning(f"Claudeバッチ {batch_id} のキャンセルに失敗しました: {str(e)}")
+
     async def ask_tool(
         self,
         messages: List[Union[dict, Message]],
         system_msgs: Optional[List[Union[dict, Message]]] = None,
         tools: Optional[List[Dict]] = None,
         tool_choice: str = "auto",
+        temperature: Optional[float] = None,
         **kwargs,
     ):
         """
         ツール呼び出し対応のリクエストを実行します
         """
         try:
-            # メッセージの準備
-            formatted_messages = []
-            
-            # システムメッセージが提供されている場合、別途保持
-            system_message = ""
-            if system_msgs and len(system_msgs) > 0:
-                system_contents = []
-                for sys_msg in system_msgs:
-                    if isinstance(sys_msg, dict):
-                        system_contents.append(sys_msg.get("content", ""))
-                    elif isinstance(sys_msg, Message):
-                        if sys_msg.role == "system":
-                            system_contents.append(sys_msg.content)
-                system_message = "\n".join(system_contents)
-            
-            # ユーザーおよびアシスタントメッセージを追加
-            formatted_messages.extend(self.format_messages(messages))
-            
+            # システムメッセージは別途保持し、ユーザーおよびアシスタントメッセージを整形
+            system_message = self._extract_system(system_msgs)
+            formatted_messages = self.format_messages(messages)
+
             # トークン数をチェック
             self.check_token_limit(formatted_messages)
-            
-            # Claude API形式に変換
-            claude_messages = []
-            
-            for msg in formatted_messages:
-                role = msg["role"]
-                content = msg["content"]
-                
-                if role == "user":
-                    claude_messages.append({"role": "user", "content": content})
-                elif role == "assistant":
-                    claude_messages.append({"role": "assistant", "content": content})
-                elif role == "system":
-                    # システムメッセージが複数ある場合、最後のものを使用
-                    system_message = content
-            
+
+            # Claude API形式に変換（整形済みのdictは作り直さずにそのまま使う）
+            claude_messages, system_message = self._split_system(
+                formatted_messages, system_message
+            )
+
+            claude_messages = self._mark_history_cache(claude_messages)
+
             # ツールをClaude形式に変換
             claude_tools = []
-            
+
             if tools:
                 for tool in tools:
                     if "function" in tool:
                         function_data = tool["function"]
-                        claude_tools.append({
-                            "name": function_data.get("name", ""),
-                            "description": function_data.get("description", ""),
-                            "input_schema": function_data.get("parameters", {})
-                        })
-            
+                        claude_tools.append(
+                            {
+                                "name": function_data.get("name", ""),
+                                "description": function_data.get("description", ""),
+                                "input_schema": function_data.get("parameters", {}),
+                            }
+                        )
+
+            # ツール定義は毎ターン同一のため、最後のツールまでをキャッシュ対象にする
+            if claude_tools and self.prompt_cache:
+                claude_tools[-1] = {
+                    **claude_tools[-1],
+                    "cache_control": {"type": "ephemeral"},
+                }
+
             # レスポンス取得
-            response = await self.client.messages.create(
-                model=self.model,
-                messages=claude_messages,
-                system=system_message if system_message else None,
-                temperature=0.6,
-                max_tokens=self.max_output_tokens,
-                tools=claude_tools if claude_tools else None
-            )
-            
-            # レスポンスからツール呼び出し情報を取得
-            content = response.content[0].text if response.content and response.content[0].text else ""
-            
-            # Tool callsを検出する
+            async with self._request_semaphore:
+                response = await self.client.messages.create(
+                    model=self.model,
+                    messages=claude_messages,
+                    system=self._system_param(system_message),
+                    temperature=0.6 if temperature is None else temperature,
+                    max_tokens=self.max_output_tokens,
+                    tools=claude_tools if claude_tools else None,
+                )
+            self._log_cache_usage(response)
+
+            # テキストとツール呼び出し（tool_useブロック）を一度の走査で取り出す
+            text_parts = []
             tool_calls = []
-            
-            if hasattr(response, "content"):
-                for content_block in response.content:
-                    if hasattr(content_block, "type") and content_block.type == "tool_use":
-                        tool_use = content_block.tool_use
-                        tool_calls.append({
-                            "id": f"call_{len(tool_calls)}",
+            for block in response.content or ():
+                block_type = getattr(block, "type", None)
+                if block_type == "text":
+                    text_parts.append(block.text)
+                elif block_type == "tool_use":
+                    tool_calls.append(
+                        {
+                            "id": getattr(block, "id", None)
+                            or f"call_{len(tool_calls)}",
                             "type": "function",
                             "function": {
-                                "name": tool_use.name,
-                                "arguments": json.dumps(tool_use.input)
-                            }
-                        })
-            
-            # SimpleNamespaceを使用してレスポンスオブジェクトを作成
-            from types import SimpleNamespace
-            result = SimpleNamespace()
-            result.content = content
-            result.tool_calls = tool_calls
-            
-            return result
-                
+                                "name": block.name,
+                                "arguments": orjson.dumps(block.input).decode(),
+                            },
+                        }
+                    )
+
+            return ToolResponse("".join(text_parts), tool_calls)
+
         except Exception as e:
             logger.error(f"Error in Claude API tool request: {str(e)}")
             raise
-            
+
     def check_token_limit(self, messages: List[Union[dict, Message]]) -> bool:
         """
         メッセージのトークン数がモデルの制限を超えていないか確認します
         超えている場合はエラーを発生させます
         """
-        from app.token_counter import TokenCounter
-        
         # プロバイダ名を取得
         provider = "claude"
-        
-        # トークン数を計算
-        result = TokenCounter.check_context_limit(messages, provider)
-        
+
+        # トークン数を計算（制限から十分遠い場合はBPEを使わない見積もりで判定）
+        result = TokenCounter.check_context_limit(messages, provider, approx=True)
+
         if not result["is_within_limit"]:
             logger.warning(
                 f"トークン数が制限を超えています: {result['total_tokens']} > {result['max_tokens']}"
@@ -272,9 +444,9 @@ class ClaudeLLM:
                 f"メッセージのトークン数 ({result['total_tokens']}) がClaudeモデルの制限 ({result['max_tokens']}) を超えています。"
                 f"会話を新しいスレッドで開始するか、古いメッセージを削除してください。"
             )
-        
+
         return True
-        
+
     async def process_conversation_thread(
         self,
         thread: "ConversationThread",
@@ -286,11 +458,12 @@ class ClaudeLLM:
         """
         会話スレッドに対してリクエストを処理します
         """
-        # メッセージをスレッドに追加
-        thread.add_user_message(user_message)
-        
-        # コンテキスト制限をチェック
-        context_info = thread.check_context_limit()
+        # ユーザーメッセージは応答と合わせてadd_turnで一度に追加する
+        user_msg = Message.user_message(user_message)
+
+        # コンテキスト制限をチェック（未追加のユーザーメッセージを含める）
+        # 使用率が閾値を超えている場合は古いターンを要約して圧縮する
+        context_info = await compact_if_needed(self, thread, [user_msg])
         if not context_info["is_within_limit"]:
             # コンテキスト制限を超えている場合、制限に関する情報をレスポンスとしてアシスタントメッセージを追加
             warning_message = (
@@ -298,24 +471,23 @@ class ClaudeLLM:
                 f"現在のトークン数: {context_info['total_tokens']}トークン\n\n"
                 f"新しい会話スレッドを開始することをお勧めします。"
             )
-            thread.add_assistant_message(warning_message)
+            thread.add_turn(user_message, warning_message)
             return warning_message
-        
+
         try:
             # AIモデルに問い合わせ
             response = await self.ask(
-                messages=thread.memory.messages,
+                messages=[*thread.memory.messages, user_msg],
                 system_msgs=system_msgs,
                 stream=stream,
-                temperature=temperature
+                temperature=temperature,
+                # コンテキスト制限は上で確認済み
+                _skip_token_check=True,
             )
-            
-            # レスポンスをスレッドに追加
-            thread.add_assistant_message(response)
-            
-            return response
         except Exception as e:
-            error_message = f"エラーが発生しました: {str(e)}"
-            logger.error(error_message)
-            thread.add_assistant_message(error_message)
-            return error_message 
\ No newline at end of file
+            response = f"エラーが発生しました: {str(e)}"
+            logger.error(response)
+
+        # ユーザーメッセージと応答（またはエラー）をまとめてスレッドに追加
+        thread.add_turn(user_message, response)
+        return response
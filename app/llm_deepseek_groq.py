@@ -1,166 +1,206 @@
+import asyncio
+import io
 import os
-import json
-import aiohttp
+import threading
 from typing import Dict, List, Optional, Union
-from tenacity import retry, stop_after_attempt, wait_random_exponential
 
-from app.schema import Message, ConversationThread
+import httpx
+import orjson
+
+from app.compaction import compact_if_needed
+from app.exceptions import RetryableAPIError
+from app.http_client import create_async_client
+from app.http_retry import RETRYABLE_STATUSES, http_api_retry, parse_retry_after
 from app.logger import logger
+from app.schema import ConversationThread, Message, ToolResponse, to_api_messages
+from app.stream_writer import StreamWriter
+from app.token_counter import TokenCounter
 
 
 class DeepSeekGroqLLM:
     """
     Groq API経由でのDeepSeek R1 Distill Llama-70Bモデルインターフェース実装クラス
     """
+
     _instance = None
+    _lock = threading.Lock()
+    # プロセス全体で共有するHTTPクライアント
+    _client: Optional[httpx.AsyncClient] = None
 
     def __new__(cls):
+        # スレッドから同時に呼ばれても一つのインスタンスだけを生成する（ダブルチェックロッキング）
         if cls._instance is None:
-            cls._instance = super().__new__(cls)
-            cls._instance._initialized = False
+            with cls._lock:
+                if cls._instance is None:
+                    instance = super().__new__(cls)
+                    instance._initialized = False
+                    cls._instance = instance
         return cls._instance
 
     def __init__(self):
         if self._initialized:
             return
-            
-        # 環境変数から設定を読み込み
-        self.api_key = os.getenv("GROQ_API_KEY", "")
-        self.api_url = os.getenv("GROQ_API_URL", "https://api.groq.com")
-        self.model = os.getenv("GROQ_DEEPSEEK_MODEL", "deepseek-r1-distill-llama-70b")
-        
-        # コンテキストウィンドウサイズを取得
-        self.max_context_tokens = int(os.getenv("GROQ_MAX_CONTEXT_TOKENS", "128000"))
-        self.max_output_tokens = int(os.getenv("GROQ_MAX_OUTPUT_TOKENS", "4096"))
-        
-        if not self.api_key:
-            raise ValueError("GROQ_API_KEY環境変数が設定されていません")
-        
-        self._initialized = True
-    
+        with self._lock:
+            if self._initialized:
+                return
+
+            # 環境変数から設定を読み込み
+            self.api_key = os.getenv("GROQ_API_KEY", "")
+            self.api_url = os.getenv("GROQ_API_URL", "https://api.groq.com")
+            self.model = os.getenv(
+                "GROQ_DEEPSEEK_MODEL", "deepseek-r1-distill-llama-70b"
+            )
+
+            # コンテキストウィンドウサイズを取得
+            self.max_context_tokens = int(
+                os.getenv("GROQ_MAX_CONTEXT_TOKENS", "128000")
+            )
+            self.max_output_tokens = int(os.getenv("GROQ_MAX_OUTPUT_TOKENS", "4096"))
+
+            if not self.api_key:
+                raise ValueError("GROQ_API_KEY環境変数が設定されていません")
+
+            # リクエストごとに変化しないURL・ヘッダー・共通パラメータ
+            self._chat_url = f"{self.api_url}/v1/chat/completions"
+            self._headers = {
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {self.api_key}",
+            }
+            self._base_payload = {
+                "model": self.model,
+                "max_tokens": self.max_output_tokens,
+            }
+
+            # 同時に送信中のリクエスト数の上限（バースト時のレート制限（429）の連鎖を防ぐ）
+            self._request_semaphore = asyncio.Semaphore(
+                max(1, int(os.getenv("GROQ_MAX_CONCURRENCY", "16")))
+            )
+
+            self._initialized = True
+
+    @classmethod
+    def _get_client(cls) -> httpx.AsyncClient:
+        """
+        全リクエストで共有するHTTPクライアントを取得します（初回利用時に生成）
+        接続を使い回し、HTTP/2が使える場合は同時リクエストを一本の接続に多重化します
+        """
+        if cls._client is None or cls._client.is_closed:
+            cls._client = create_async_client()
+        return cls._client
+
+    @classmethod
+    async def aclose(cls) -> None:
+        """
+        共有HTTPクライアントを閉じます
+        """
+        if cls._client is not None and not cls._client.is_closed:
+            await cls._client.aclose()
+        cls._client = None
+
     @staticmethod
     def format_messages(messages: List[Union[dict, Message]]) -> List[Dict]:
         """
         メッセージをGroq API形式に変換します
         """
-        formatted_messages = []
-        
-        for message in messages:
-            if isinstance(message, dict):
-                formatted_messages.append({
-                    "role": message.get("role", "user"),
-                    "content": message.get("content", "")
-                })
-            elif isinstance(message, Message):
-                formatted_messages.append({
-                    "role": message.role,
-                    "content": message.content
-                })
-            else:
-                raise TypeError(f"Unsupported message type: {type(message)}")
-                
-        return formatted_messages
-    
-    @retry(
-        wait=wait_random_exponential(min=1, max=60),
-        stop=stop_after_attempt(6),
-    )
+        return to_api_messages(messages)
+
+    @http_api_retry
     async def ask(
         self,
         messages: List[Union[dict, Message]],
         system_msgs: Optional[List[Union[dict, Message]]] = None,
         stream: bool = False,
         temperature: Optional[float] = None,
+        _skip_token_check: bool = False,
     ) -> str:
         """
         Groq APIにリクエストを送信し、レスポンスを取得します
+        _skip_token_check: 呼び出し側でコンテキスト制限を確認済みの場合にトークン数の再チェックを省略する（内部用）
         """
         try:
-            # メッセージの準備
-            formatted_messages = []
-            
-            # システムメッセージが提供されている場合、最初に追加
-            if system_msgs and len(system_msgs) > 0:
-                for sys_msg in system_msgs:
-                    if isinstance(sys_msg, dict):
-                        formatted_messages.append({
-                            "role": "system",
-                            "content": sys_msg.get("content", "")
-                        })
-                    elif isinstance(sys_msg, Message):
-                        if sys_msg.role == "system":
-                            formatted_messages.append({
-                                "role": "system",
-                                "content": sys_msg.content
-                            })
-            
-            # ユーザーおよびアシスタントメッセージを追加
-            formatted_messages.extend(self.format_messages(messages))
-            
-            # トークン数をチェック
-            self.check_token_limit(formatted_messages)
-                
+            # システムメッセージとユーザーおよびアシスタントメッセージを一度に整形
+            formatted_messages = to_api_messages(messages, system_msgs)
+
+            # トークン数をチェック（呼び出し側で確認済みの場合は省略）
+            if not _skip_token_check:
+                self.check_token_limit(formatted_messages)
+
             # ペイロード構築
             payload = {
-                "model": self.model,
+                **self._base_payload,
                 "messages": formatted_messages,
-                "max_tokens": self.max_output_tokens,
                 "temperature": 0.6 if temperature is None else temperature,
                 "top_p": 0.95,
-                "stream": stream
+                "stream": stream,
             }
-            
+
             # リクエスト送信
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{self.api_url}/v1/chat/completions",
-                    json=payload,
-                    headers={
-                        "Content-Type": "application/json", 
-                        "Authorization": f"Bearer {self.api_key}"
-                    }
-                ) as response:
-                    if response.status != 200:
-                        error_text = await response.text()
-                        logger.error(f"Groq API error: {response.status} - {error_text}")
-                        raise ValueError(f"API request failed with status {response.status}: {error_text}")
-                    
-                    if stream:
-                        # ストリーミングレスポンスの処理
-                        collected_content = []
-                        async for line in response.content:
-                            if line:
-                                line_text = line.decode("utf-8").strip()
-                                if line_text.startswith("data: "):
-                                    data = line_text[6:]
-                                    if data != "[DONE]":
-                                        try:
-                                            chunk = json.loads(data)
-                                            delta = chunk["choices"][0]["delta"]
-                                            if "content" in delta:
-                                                content = delta["content"]
-                                                collected_content.append(content)
-                                                print(content, end="", flush=True)
-                                        except json.JSONDecodeError:
-                                            pass
-                        
-                        print()  # 最後に改行
-                        return "".join(collected_content)
-                    else:
-                        # 通常レスポンスの処理
-                        result = await response.json()
-                        return result["choices"][0]["message"]["content"]
-                    
+            client = self._get_client()
+            async with self._request_semaphore, client.stream(
+                "POST",
+                self._chat_url,
+                content=orjson.dumps(payload),
+                headers=self._headers,
+            ) as response:
+                if response.status_code != 200:
+                    error_text = (await response.aread()).decode("utf-8", "replace")
+                    logger.error(
+                        f"Groq API error: {response.status_code} - {error_text}"
+                    )
+                    message = f"API request failed with status {response.status_code}: {error_text}"
+                    # 429/5xxのみRetry-Afterに従って再試行し、それ以外は即座に失敗させる
+                    if response.status_code in RETRYABLE_STATUSES:
+                        raise RetryableAPIError(
+                            message,
+                            status=response.status_code,
+                            retry_after=parse_retry_after(
+                                response.headers.get("Retry-After")
+                            ),
+                        )
+                    raise ValueError(message)
+
+                if stream:
+                    # ストリーミングレスポンスの処理
+                    collected_content = io.StringIO()
+                    writer = StreamWriter()
+                    async for line in response.aiter_lines():
+                        # SSEのdata行のみを解析
+                        if not line.startswith("data: "):
+                            continue
+                        data = line[6:].rstrip()
+                        if data == "[DONE]":
+                            # 終端イベント以降は読まずに打ち切る
+                            break
+                        if not data:
+                            continue
+                        try:
+                            chunk = orjson.loads(data)
+                            delta = chunk["choices"][0]["delta"]
+                            if "content" in delta:
+                                content = delta["content"]
+                                collected_content.write(content)
+                                writer.write(content)
+                        except orjson.JSONDecodeError:
+                            pass
+
+                    writer.close()  # 残りを書き出して改行
+                    return collected_content.getvalue()
+                else:
+                    # 通常レスポンスの処理
+                    result = orjson.loads(await response.aread())
+                    return result["choices"][0]["message"]["content"]
+
         except Exception as e:
             logger.error(f"Error in Groq API request: {str(e)}")
             raise
-            
+
     async def ask_tool(
         self,
         messages: List[Union[dict, Message]],
         system_msgs: Optional[List[Union[dict, Message]]] = None,
         tools: Optional[List[dict]] = None,
         tool_choice: str = "auto",
+        temperature: Optional[float] = None,
         **kwargs,
     ):
         """
@@ -170,72 +210,47 @@ class DeepSeekGroqLLM:
         """
         try:
             # 現時点ではツール呼び出しは標準的な方法で実装します
-            # メッセージの準備
-            formatted_messages = []
-            
-            # システムメッセージが提供されている場合、最初に追加
-            if system_msgs and len(system_msgs) > 0:
-                for sys_msg in system_msgs:
-                    if isinstance(sys_msg, dict):
-                        formatted_messages.append({
-                            "role": "system",
-                            "content": sys_msg.get("content", "")
-                        })
-                    elif isinstance(sys_msg, Message):
-                        if sys_msg.role == "system":
-                            formatted_messages.append({
-                                "role": "system",
-                                "content": sys_msg.content
-                            })
-            
-            # ユーザーおよびアシスタントメッセージを追加
-            formatted_messages.extend(self.format_messages(messages))
-            
+            # システムメッセージとユーザーおよびアシスタントメッセージを一度に整形
+            formatted_messages = to_api_messages(messages, system_msgs)
+
             # トークン数をチェック
             self.check_token_limit(formatted_messages)
-                
+
             # ペイロード構築
             payload = {
-                "model": self.model,
+                **self._base_payload,
                 "messages": formatted_messages,
-                "max_tokens": self.max_output_tokens,
-                "temperature": 0.6
+                "temperature": 0.6 if temperature is None else temperature,
             }
-            
+
             # ツール情報が提供されている場合、ペイロードに追加
             if tools:
                 payload["tools"] = tools
                 payload["tool_choice"] = tool_choice
-            
+
             # リクエスト送信
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{self.api_url}/v1/chat/completions",
-                    json=payload,
-                    headers={
-                        "Content-Type": "application/json", 
-                        "Authorization": f"Bearer {self.api_key}"
-                    }
-                ) as response:
-                    if response.status != 200:
-                        error_text = await response.text()
-                        logger.error(f"Groq API error: {response.status} - {error_text}")
-                        raise ValueError(f"API request failed with status {response.status}: {error_text}")
-                    
-                    # レスポンスの解析
-                    result = await response.json()
-                    response_message = result["choices"][0]["message"]
-                    content = response_message.get("content", "")
-                    tool_calls = response_message.get("tool_calls", [])
-                    
-                    # ツール呼び出し情報を含むレスポンスオブジェクトを返す
-                    from types import SimpleNamespace
-                    response = SimpleNamespace()
-                    response.content = content
-                    response.tool_calls = tool_calls
-                    
-                    return response
-                    
+            client = self._get_client()
+            async with self._request_semaphore:
+                response = await client.post(
+                    self._chat_url, content=orjson.dumps(payload), headers=self._headers
+                )
+            if response.status_code != 200:
+                logger.error(
+                    f"Groq API error: {response.status_code} - {response.text}"
+                )
+                raise ValueError(
+                    f"API request failed with status {response.status_code}: {response.text}"
+                )
+
+            # レスポンスの解析
+            result = orjson.loads(response.content)
+            response_message = result["choices"][0]["message"]
+            content = response_message.get("content", "")
+            tool_calls = response_message.get("tool_calls", [])
+
+            # ツール呼び出し情報を含むレスポンスオブジェクトを返す
+            return ToolResponse(content, tool_calls)
+
         except Exception as e:
             logger.error(f"Error in Groq tool API request: {str(e)}")
             raise
@@ -245,14 +260,12 @@ class DeepSeekGroqLLM:
         メッセージのトークン数がモデルの制限を超えていないか確認します
         超えている場合はエラーを発生させます
         """
-        from app.token_counter import TokenCounter
-        
         # プロバイダ名を取得
         provider = "groq_deepseek"
-        
-        # トークン数を計算
-        result = TokenCounter.check_context_limit(messages, provider)
-        
+
+        # トークン数を計算（制限から十分遠い場合はBPEを使わない見積もりで判定）
+        result = TokenCounter.check_context_limit(messages, provider, approx=True)
+
         if not result["is_within_limit"]:
             logger.warning(
                 f"トークン数が制限を超えています: {result['total_tokens']} > {result['max_tokens']}"
@@ -261,9 +274,9 @@ class DeepSeekGroqLLM:
                 f"メッセージのトークン数 ({result['total_tokens']}) がGroq DeepSeekモデルの制限 ({result['max_tokens']}) を超えています。"
                 f"会話を新しいスレッドで開始するか、古いメッセージを削除してください。"
             )
-        
+
         return True
-        
+
     async def process_conversation_thread(
         self,
         thread: "ConversationThread",
@@ -275,11 +288,12 @@ class DeepSeekGroqLLM:
         """
         会話スレッドに対してリクエストを処理します
         """
-        # メッセージをスレッドに追加
-        thread.add_user_message(user_message)
-        
-        # コンテキスト制限をチェック
-        context_info = thread.check_context_limit()
+        # ユーザーメッセージは応答と合わせてadd_turnで一度に追加する
+        user_msg = Message.user_message(user_message)
+
+        # コンテキスト制限をチェック（未追加のユーザーメッセージを含める）
+        # 使用率が閾値を超えている場合は古いターンを要約して圧縮する
+        context_info = await compact_if_needed(self, thread, [user_msg])
         if not context_info["is_within_limit"]:
             # コンテキスト制限を超えている場合、制限に関する情報をレスポンスとしてアシスタントメッセージを追加
             warning_message = (
@@ -287,24 +301,23 @@ class DeepSeekGroqLLM:
                 f"現在のトークン数: {context_info['total_tokens']}トークン\n\n"
                 f"新しい会話スレッドを開始することをお勧めします。"
             )
-            thread.add_assistant_message(warning_message)
+            thread.add_turn(user_message, warning_message)
             return warning_message
-        
+
         try:
             # AIモデルに問い合わせ
             response = await self.ask(
-                messages=thread.memory.messages,
+                messages=[*thread.memory.messages, user_msg],
                 system_msgs=system_msgs,
                 stream=stream,
-                temperature=temperature
+                temperature=temperature,
+                # コンテキスト制限は上で確認済み
+                _skip_token_check=True,
             )
-            
-            # レスポンスをスレッドに追加
-            thread.add_assistant_message(response)
-            
-            return response
         except Exception as e:
-            error_message = f"エラーが発生しました: {str(e)}"
-            logger.error(error_message)
-            thread.add_assistant_message(error_message)
-            return error_message 
\ No newline at end of file
+            response = f"エラーが発生しました: {str(e)}"
+            logger.error(response)
+
+        # ユーザーメッセージと応答（またはエラー）をまとめてスレッドに追加
+        thread.add_turn(user_message, response)
+        return response
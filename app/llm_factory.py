@@ -1,13 +1,63 @@
+import asyncio
+import functools
+import importlib
 import os
-from typing import Dict, List, Optional, Union, Any
+import sys
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Union
 
+from app.llm_cache import LLMCache
 from app.logger import logger
-from app.schema import Message, AIProvider, ConversationThread
-from app.llm_gemini import GeminiLLM
-from app.llm_claude import ClaudeLLM
-from app.llm_openai import OpenAILLM
-from app.llm_llama_groq import LlamaGroqLLM
-from app.llm_deepseek_groq import DeepSeekGroqLLM
+from app.schema import (
+    AIProvider,
+    ConversationThread,
+    Message,
+    ToolResponse,
+    to_api_messages,
+)
+
+
+if TYPE_CHECKING:
+    from app.llm_claude import ClaudeLLM
+    from app.llm_deepseek_groq import DeepSeekGroqLLM
+    from app.llm_gemini import GeminiLLM
+    from app.llm_llama_groq import LlamaGroqLLM
+    from app.llm_openai import OpenAILLM
+
+
+# プロバイダ名と（モジュール名, LLMクラス名）の対応
+# 各プロバイダのSDKは重いため、実際に使われるプロバイダのモジュールだけを初回利用時にインポートする
+_PROVIDER_MAP = {
+    AIProvider.GEMINI.value: ("app.llm_gemini", "GeminiLLM"),
+    AIProvider.OPENAI.value: ("app.llm_openai", "OpenAILLM"),
+    AIProvider.CLAUDE.value: ("app.llm_claude", "ClaudeLLM"),
+    AIProvider.GROQ_LLAMA.value: ("app.llm_llama_groq", "LlamaGroqLLM"),
+    AIProvider.GROQ_DEEPSEEK.value: ("app.llm_deepseek_groq", "DeepSeekGroqLLM"),
+}
+
+
+@functools.lru_cache(maxsize=16)
+def _resolve_llm(
+    provider: str,
+) -> "Union[GeminiLLM, OpenAILLM, ClaudeLLM, LlamaGroqLLM, DeepSeekGroqLLM]":
+    """
+    正規化済みのプロバイダ名からLLMインスタンスを生成（プロバイダごとに一度だけ）
+    """
+    target = _PROVIDER_MAP.get(provider)
+    if target is None:
+        # デフォルトはGemini
+        logger.warning(f"不明なプロバイダ '{provider}' が指定されました。デフォルトのGeminiLLMを使用します。")
+        target = _PROVIDER_MAP[AIProvider.GEMINI.value]
+    module_name, class_name = target
+    llm_class = getattr(importlib.import_module(module_name), class_name)
+    logger.info(f"{class_name}を使用します")
+    return llm_class()
+
+
+def _normalize_provider(provider: Optional[str]) -> str:
+    """
+    プロバイダ名を正規化（未指定の場合は環境変数AI_PROVIDERを使用）
+    """
+    return (provider or os.getenv("AI_PROVIDER", "gemini")).lower()
 
 
 class LLMFactory:
@@ -15,38 +65,21 @@ class LLMFactory:
     LLMのファクトリークラス
     環境変数に基づいて適切なLLMインスタンスを提供します
     """
-    
+
+    # temperature=0のリクエストに対するレスポンスキャッシュ
+    _cache: LLMCache = LLMCache.from_env()
+
     @staticmethod
-    def get_llm(provider: Optional[str] = None) -> Union[GeminiLLM, OpenAILLM, ClaudeLLM, LlamaGroqLLM, DeepSeekGroqLLM]:
+    def get_llm(
+        provider: Optional[str] = None,
+    ) -> "Union[GeminiLLM, OpenAILLM, ClaudeLLM, LlamaGroqLLM, DeepSeekGroqLLM]":
         """
         指定されたプロバイダに基づいてLLMインスタンスを取得します
         未指定の場合は環境変数から読み込みます
         """
-        if not provider:
-            # 環境変数からプロバイダを取得
-            provider = os.getenv("AI_PROVIDER", "gemini").lower()
-        
-        # プロバイダに基づいてLLMを初期化して返す
-        if provider == AIProvider.GEMINI.value.lower() or provider == "gemini":
-            logger.info("GeminiLLMを使用します")
-            return GeminiLLM()
-        elif provider == AIProvider.OPENAI.value.lower() or provider == "openai":
-            logger.info("OpenAILLMを使用します")
-            return OpenAILLM()
-        elif provider == AIProvider.CLAUDE.value.lower() or provider == "claude":
-            logger.info("ClaudeLLMを使用します")
-            return ClaudeLLM()
-        elif provider == AIProvider.GROQ_LLAMA.value.lower() or provider == "groq_llama":
-            logger.info("LlamaGroqLLMを使用します")
-            return LlamaGroqLLM()
-        elif provider == AIProvider.GROQ_DEEPSEEK.value.lower() or provider == "groq_deepseek":
-            logger.info("DeepSeekGroqLLMを使用します")
-            return DeepSeekGroqLLM()
-        else:
-            # デフォルトはGemini
-            logger.warning(f"不明なプロバイダ '{provider}' が指定されました。デフォルトのGeminiLLMを使用します。")
-            return GeminiLLM()
-    
+        # プロバイダ名は一度だけ正規化し、解決結果はキャッシュから返す
+        return _resolve_llm(_normalize_provider(provider))
+
     @classmethod
     async def ask_with_provider(
         cls,
@@ -60,13 +93,57 @@ class LLMFactory:
         指定されたプロバイダを使用してAIに問い合わせます
         """
         llm = cls.get_llm(provider)
-        return await llm.ask(
+
+        # 決定的なリクエスト（temperature=0かつ非ストリーミング）のみキャッシュする
+        cacheable = not stream and temperature is not None and temperature <= 0
+        if cacheable:
+            key = cls._cache_key(llm, messages, system_msgs, temperature=temperature)
+            cached = cls._cache.get(key)
+            if cached is not None:
+                return cached
+
+        response = await llm.ask(
             messages=messages,
             system_msgs=system_msgs,
             stream=stream,
-            temperature=temperature
+            temperature=temperature,
+        )
+        if cacheable:
+            cls._cache.set(key, response)
+        return response
+
+    @classmethod
+    async def ask_batch_with_provider(
+        cls,
+        message_lists: List[List[Union[dict, Message]]],
+        provider: Optional[str] = None,
+        system_msgs: Optional[List[Union[dict, Message]]] = None,
+        temperature: Optional[float] = None,
+    ) -> List[str]:
+        """
+        指定されたプロバイダを使用して複数の独立したリクエストをまとめて処理します
+        バッチAPIに対応したプロバイダ（Claude）ではバッチAPIを使い、それ以外は並行して問い合わせます
+        """
+        llm = cls.get_llm(provider)
+        if hasattr(llm, "ask_batch"):
+            return await llm.ask_batch(
+                message_lists, system_msgs=system_msgs, temperature=temperature
+            )
+        # 同時実行数は各プロバイダのクライアントが持つセマフォで制限される
+        return list(
+            await asyncio.gather(
+                *[
+                    cls.ask_with_provider(
+                        messages,
+                        provider=provider,
+                        system_msgs=system_msgs,
+                        temperature=temperature,
+                    )
+                    for messages in message_lists
+                ]
+            )
         )
-    
+
     @classmethod
     async def ask_tool_with_provider(
         cls,
@@ -81,14 +158,54 @@ class LLMFactory:
         指定されたプロバイダを使用してツール呼び出し対応のリクエストを実行します
         """
         llm = cls.get_llm(provider)
-        return await llm.ask_tool(
+
+        # temperature=0が明示された場合のみキャッシュする（各プロバイダのask_toolはtemperatureをそのまま使う）
+        temperature = kwargs.get("temperature")
+        cacheable = temperature is not None and temperature <= 0
+        if cacheable:
+            key = cls._cache_key(
+                llm,
+                messages,
+                system_msgs,
+                tools=tools,
+                tool_choice=tool_choice,
+                temperature=temperature,
+            )
+            cached = cls._cache.get(key)
+            if cached is not None:
+                # 呼び出し側での変更がキャッシュに波及しないよう新しいオブジェクトを返す
+                return ToolResponse(cached.content, list(cached.tool_calls))
+
+        response = await llm.ask_tool(
             messages=messages,
             system_msgs=system_msgs,
             tools=tools,
             tool_choice=tool_choice,
-            **kwargs
+            **kwargs,
+        )
+        if cacheable:
+            cls._cache.set(
+                key, ToolResponse(response.content, list(response.tool_calls or []))
+            )
+        return response
+
+    @staticmethod
+    def _cache_key(
+        llm: Any,
+        messages: List[Union[dict, Message]],
+        system_msgs: Optional[List[Union[dict, Message]]],
+        **params: Any,
+    ) -> str:
+        """
+        プロバイダ・モデル・メッセージ・パラメータからキャッシュキーを生成します
+        """
+        return LLMCache.make_key(
+            provider=type(llm).__name__,
+            model=getattr(llm, "model", None) or getattr(llm, "model_name", None),
+            messages=to_api_messages(messages, system_msgs),
+            **params,
         )
-        
+
     @classmethod
     async def process_conversation_thread(
         cls,
@@ -108,13 +225,35 @@ class LLMFactory:
             user_message=user_message,
             system_msgs=system_msgs,
             stream=stream,
-            temperature=temperature
+            temperature=temperature,
         )
-        
+
+    @staticmethod
+    async def aclose_all() -> None:
+        """
+        読み込み済みの各プロバイダが保持するHTTPセッション・接続プールを閉じます
+        プロセス終了時に呼び出してください（未使用のプロバイダのモジュールはインポートしません）
+        """
+        for module_name, class_name in _PROVIDER_MAP.values():
+            module = sys.modules.get(module_name)
+            instance = getattr(getattr(module, class_name, None), "_instance", None)
+            if instance is not None and hasattr(instance, "aclose"):
+                try:
+                    await instance.aclose()
+                except Exception as e:
+                    logger.warning(f"{class_name}の接続のクローズに失敗しました: {str(e)}")
+        # エージェントやフローが共有するOpenAI互換のLLMインスタンス
+        llm_module = sys.modules.get("app.llm")
+        if llm_module is not None:
+            try:
+                await llm_module.LLM.aclose_all()
+            except Exception as e:
+                logger.warning(f"LLMの接続のクローズに失敗しました: {str(e)}")
+
     @classmethod
     def get_context_window_size(cls, provider: Optional[str] = None) -> int:
         """
         指定されたプロバイダのコンテキストウィンドウサイズを取得します
         """
         llm = cls.get_llm(provider)
-        return llm.max_context_tokens if hasattr(llm, 'max_context_tokens') else 4096 
\ No newline at end of file
+        return llm.max_context_tokens if hasattr(llm, "max_context_tokens") else 4096
@@ -1,309 +1,409 @@
+import asyncio
+import io
 import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
 import google.generativeai as genai
-from typing import Any, Dict, List, Optional, Union
+import orjson
 
-from app.schema import Message, Function, ConversationThread
+from app.compaction import compact_if_needed
+from app.llm_cache import LLMCache, SemanticCache
 from app.logger import logger
+from app.schema import ConversationThread, Message, ToolResponse, to_api_messages
+from app.stream_writer import StreamWriter
+from app.token_counter import TokenCounter
+
+
+# API形式のロールからGeminiのロールへの変換（assistantはmodelになり、ツールの実行結果はuserとして渡す）
+_GEMINI_ROLES = {"assistant": "model", "tool": "user"}
+
+
+def _to_gemini_messages(
+    api_messages: List[Dict],
+) -> Tuple[Optional[str], List[Dict], str]:
+    """
+    API形式のメッセージを一度の走査でGemini形式に変換
+    generate_contentのcontentsはuser/modelロールのみ受け付けるため、
+    システムメッセージは取り除いてsystem_instruction用のテキストにまとめる
+    変換と同時に最後のユーザーメッセージのテキストも取得し、(システム指示, 変換結果, テキスト)を返す
+    """
+    roles = _GEMINI_ROLES
+    system_parts = []
+    formatted = []
+    last_user_text = ""
+    for msg in api_messages:
+        role = msg["role"]
+        if role == "system":
+            system_parts.append(msg["content"])
+            continue
+        if role == "user":
+            last_user_text = msg["content"]
+        formatted.append(
+            {"role": roles.get(role, role), "parts": [{"text": msg["content"]}]}
+        )
+    system_instruction = "\n\n".join(system_parts) if system_parts else None
+    return system_instruction, formatted, last_user_text
+
+
+def _iter_function_calls(response: Any) -> Iterator[Any]:
+    """
+    レスポンスの全候補・全パートに含まれるfunction_callを順に返す
+    SDKの型では属性は常に存在する（値がNoneや空の場合がある）ため、hasattrによる確認は行わない
+    """
+    for candidate in getattr(response, "candidates", None) or ():
+        for part in getattr(candidate.content, "parts", None) or ():
+            function_call = part.function_call
+            if function_call:
+                yield function_call
+
+
+def _response_text(response: Any) -> str:
+    """
+    最初の候補のテキストパートを連結して返す
+    response.textはfunction_callのみのパートで例外になるため、ツール呼び出しの応答ではこちらを使う
+    """
+    candidates = getattr(response, "candidates", None)
+    if not candidates:
+        return ""
+    parts = getattr(candidates[0].content, "parts", None) or ()
+    return "".join(part.text for part in parts if part.text)
+
+
+def _proto_to_builtin(value: Any) -> Any:
+    """
+    function_call.argsに含まれるprotoのマップ/リスト型をorjsonで扱える型に変換
+    """
+    if hasattr(value, "keys"):
+        return dict(value)
+    return list(value)
 
 
 class GeminiLLM:
     """
     Google GeminiモデルのLLMインターフェース実装クラス
     """
+
     _instance = None
+    _lock = threading.Lock()
+    # temperature・システム指示・ツール定義ごとに保持する生成済みモデルの上限
+    _MODEL_CACHE_SIZE = 32
 
     def __new__(cls):
+        # スレッドから同時に呼ばれても一つのインスタンスだけを生成する（ダブルチェックロッキング）
         if cls._instance is None:
-            cls._instance = super().__new__(cls)
-            cls._instance._initialized = False
+            with cls._lock:
+                if cls._instance is None:
+                    instance = super().__new__(cls)
+                    instance._initialized = False
+                    cls._instance = instance
         return cls._instance
 
     def __init__(self):
         if self._initialized:
             return
-            
-        # 環境変数からGoogle API Keyを取得
-        self.api_key = os.getenv("GEMINI_API_KEY", "")
-        if not self.api_key:
-            raise ValueError("GEMINI_API_KEY環境変数が設定されていません")
-            
-        # モデル情報を取得
-        self.model_name = os.getenv("GEMINI_MODEL", "gemini-flash")
-        
-        # コンテキストウィンドウサイズを取得
-        self.max_context_tokens = int(os.getenv("GEMINI_MAX_CONTEXT_TOKENS", "1000000"))
-        self.max_output_tokens = int(os.getenv("GEMINI_MAX_OUTPUT_TOKENS", "8192"))
-        
-        # Gemini APIの初期化
-        genai.configure(api_key=self.api_key)
-        
-        # モデルの生成設定
-        self.generation_config = {
-            "temperature": 0.6,
-            "top_p": 0.95,
-            "max_output_tokens": self.max_output_tokens,
-        }
-        
-        self._initialized = True
-        
+        with self._lock:
+            if self._initialized:
+                return
+
+            # 環境変数からGoogle API Keyを取得
+            self.api_key = os.getenv("GEMINI_API_KEY", "")
+            if not self.api_key:
+                raise ValueError("GEMINI_API_KEY環境変数が設定されていません")
+
+            # モデル情報を取得
+            self.model_name = os.getenv("GEMINI_MODEL", "gemini-flash")
+
+            # コンテキストウィンドウサイズを取得
+            self.max_context_tokens = int(
+                os.getenv("GEMINI_MAX_CONTEXT_TOKENS", "1000000")
+            )
+            self.max_output_tokens = int(os.getenv("GEMINI_MAX_OUTPUT_TOKENS", "8192"))
+
+            # Gemini APIの初期化
+            genai.configure(api_key=self.api_key)
+
+            # モデルの生成設定
+            self.generation_config = {
+                "temperature": 0.6,
+                "top_p": 0.95,
+                "max_output_tokens": self.max_output_tokens,
+            }
+
+            # 決定的なリクエスト（temperature=0）の完全一致レスポンスキャッシュ
+            self._response_cache = LLMCache.from_env()
+            # 言い換えられた質問にも応答を再利用する意味的キャッシュ（LLM_SEMANTIC_CACHE有効時のみ）
+            self._semantic_cache = SemanticCache.from_env()
+            # (temperature, システム指示)ごとの生成済みモデル（temperatureのNoneは既定の生成設定）
+            self._models: "OrderedDict[Tuple[Optional[float], Optional[str]], genai.GenerativeModel]" = (
+                OrderedDict()
+            )
+            # 同時に送信中のリクエスト数の上限（バースト時のレート制限（429）の連鎖を防ぐ）
+            self._request_semaphore = asyncio.Semaphore(
+                max(1, int(os.getenv("GEMINI_MAX_CONCURRENCY", "16")))
+            )
+            # ツール定義とシステム指示ごとの生成済みモデル（キーのハッシュ -> GenerativeModel）
+            self._tool_models: "OrderedDict[str, genai.GenerativeModel]" = OrderedDict()
+
+            self._initialized = True
+
     @staticmethod
     def format_messages(messages: List[Union[dict, Message]]) -> List[Dict]:
         """
         メッセージをGemini形式に変換する
         """
-        formatted_messages = []
-        
-        for message in messages:
-            if isinstance(message, dict):
-                role = message.get("role", "user")
-                content = message.get("content", "")
-                
-                # Geminiでは "user", "model", "system" のロールが有効
-                if role == "assistant":
-                    role = "model"
-                
-                formatted_messages.append({
-                    "role": role,
-                    "parts": [{"text": content}],
-                })
-            elif isinstance(message, Message):
-                role = message.role
-                content = message.content
-                
-                # Geminiでは "user", "model", "system" のロールが有効
-                if role == "assistant":
-                    role = "model"
-                
-                formatted_messages.append({
-                    "role": role,
-                    "parts": [{"text": content}],
-                })
-            else:
-                raise TypeError(f"Unsupported message type: {type(message)}")
-                
-        return formatted_messages
-        
+        # contentsでは "user", "model" のロールのみ有効（システムメッセージはsystem_instructionで渡す）
+        return _to_gemini_messages(to_api_messages(messages))[1]
+
+    @staticmethod
+    def format_system_messages(
+        system_msgs: Optional[List[Union[dict, Message]]]
+    ) -> Optional[str]:
+        """
+        システムメッセージをGeminiのsystem_instruction用のテキストに変換する
+        """
+        return _to_gemini_messages(to_api_messages([], system_msgs))[0]
+
     async def ask(
         self,
         messages: List[Union[dict, Message]],
         system_msgs: Optional[List[Union[dict, Message]]] = None,
         stream: bool = False,
         temperature: Optional[float] = None,
+        _skip_token_check: bool = False,
     ) -> str:
         """
         Gemini APIに問い合わせ、レスポンスを取得する
+        _skip_token_check: 呼び出し側でコンテキスト制限を確認済みの場合にトークン数の再チェックを省略する（内部用）
         """
         try:
-            # メッセージの準備
-            formatted_messages = []
-            
-            # システムメッセージが提供されている場合、最初に追加
-            if system_msgs and len(system_msgs) > 0:
-                for sys_msg in system_msgs:
-                    if isinstance(sys_msg, dict):
-                        formatted_messages.append({
-                            "role": "system",
-                            "parts": [{"text": sys_msg.get("content", "")}],
-                        })
-                    elif isinstance(sys_msg, Message):
-                        if sys_msg.role == "system":
-                            formatted_messages.append({
-                                "role": "system",
-                                "parts": [{"text": sys_msg.content}],
-                            })
-            
-            # ユーザーおよびアシスタントメッセージを追加
-            formatted_messages.extend(self.format_messages(messages))
-            
-            # トークン数をチェック
-            self.check_token_limit(formatted_messages)
-            
-            # モデルを初期化
-            model = genai.GenerativeModel(
-                model_name=self.model_name,
-                generation_config={
-                    **self.generation_config,
-                    **({"temperature": temperature} if temperature is not None else {})
-                }
-            )
-            
-            # チャットセッションを作成してメッセージを送信
-            chat = model.start_chat(history=formatted_messages)
-            last_user_message = ""
-            
-            # 最後のユーザーメッセージを取得
-            for msg in reversed(formatted_messages):
-                if msg["role"] == "user":
-                    if "parts" in msg and msg["parts"] and "text" in msg["parts"][0]:
-                        last_user_message = msg["parts"][0]["text"]
-                        break
-            
+            # システムメッセージを先頭に、ユーザーおよびアシスタントメッセージを続けて一度に整形
+            api_messages = to_api_messages(messages, system_msgs)
+            (
+                system_instruction,
+                formatted_messages,
+                last_user_message,
+            ) = _to_gemini_messages(api_messages)
+
+            # トークン数をチェック（呼び出し側で確認済みの場合は省略）
+            if not _skip_token_check:
+                self.check_token_limit(api_messages)
+
+            # 決定的なリクエスト（temperature=0かつ非ストリーミング）はキャッシュを参照
+            cache_key = None
+            if not stream and temperature is not None and temperature <= 0:
+                cache_key = LLMCache.make_key(
+                    model=self.model_name,
+                    system=system_instruction,
+                    messages=formatted_messages,
+                    temperature=temperature,
+                )
+                cached = self._response_cache.get(cache_key)
+                if cached is not None:
+                    return cached
+
+            # 低温度（0.2以下）かつ非ストリーミングのリクエストは意味的キャッシュも参照
+            semantic_query = None
+            if (
+                self._semantic_cache is not None
+                and not stream
+                and temperature is not None
+                and temperature <= 0.2
+            ):
+                semantic_query = SemanticCache.split_query(
+                    self.model_name, api_messages
+                )
+                if semantic_query is not None:
+                    cached = await self._semantic_cache.get(*semantic_query)
+                    if cached is not None:
+                        return cached
+
+            # temperatureとシステム指示ごとに生成済みのモデルを再利用
+            model = self._get_model(temperature, system_instruction)
+
+            # 最後のユーザーメッセージは整形時に取得済み
             if not last_user_message:
                 raise ValueError("ユーザーメッセージが見つかりません")
-            
-            # レスポンスを取得
+
+            # 履歴全体（最後のユーザーメッセージを含む）を一度のリクエストで送信
             if stream:
-                # ストリーミングレスポンスの処理
-                response_stream = chat.send_message(last_user_message, stream=True)
-                collected_content = []
-                
-                for chunk in response_stream:
-                    if hasattr(chunk, "text"):
-                        text = chunk.text
-                        collected_content.append(text)
-                        print(text, end="", flush=True)
-                
-                print()  # 最後に改行
-                return "".join(collected_content)
+                # ストリーミングレスポンスの処理（ストリームを読み終えるまで同時実行数の枠を保持）
+                collected_content = io.StringIO()
+                writer = StreamWriter()
+                async with self._request_semaphore:
+                    response_stream = await model.generate_content_async(
+                        formatted_messages, stream=True
+                    )
+                    async for chunk in response_stream:
+                        if hasattr(chunk, "text"):
+                            text = chunk.text
+                            collected_content.write(text)
+                            writer.write(text)
+
+                writer.close()  # 残りを書き出して改行
+                return collected_content.getvalue()
             else:
                 # 通常レスポンスの処理
-                response = chat.send_message(last_user_message)
+                async with self._request_semaphore:
+                    response = await model.generate_content_async(formatted_messages)
+                if cache_key is not None:
+                    self._response_cache.set(cache_key, response.text)
+                if semantic_query is not None:
+                    await self._semantic_cache.set(*semantic_query, response.text)
                 return response.text
-                
+
         except Exception as e:
             logger.error(f"Error in Gemini API request: {str(e)}")
             raise
 
+    def _get_model(
+        self, temperature: Optional[float], system_instruction: Optional[str] = None
+    ) -> "genai.GenerativeModel":
+        """
+        temperatureとシステム指示に対応するモデルを取得します（temperature未指定の場合は既定の生成設定）
+        """
+        key = (
+            None if temperature is None else round(temperature, 2),
+            system_instruction,
+        )
+        model = self._models.get(key)
+        if model is not None:
+            self._models.move_to_end(key)
+            return model
+
+        model = genai.GenerativeModel(
+            model_name=self.model_name,
+            generation_config={
+                **self.generation_config,
+                **({"temperature": key[0]} if key[0] is not None else {}),
+            },
+            system_instruction=system_instruction,
+        )
+        self._models[key] = model
+        if len(self._models) > self._MODEL_CACHE_SIZE:
+            self._models.popitem(last=False)
+        return model
+
+    def _get_tool_model(
+        self,
+        tools: Optional[List[Dict]],
+        system_instruction: Optional[str] = None,
+        temperature: Optional[float] = None,
+    ) -> "genai.GenerativeModel":
+        """
+        ツール定義をGemini形式に変換したモデルを取得します
+        同じツール定義・システム指示・temperatureではエージェントのターンをまたいで変換済みのモデルを再利用します
+        """
+        temperature = None if temperature is None else round(temperature, 2)
+        key = LLMCache.make_key(
+            tools=tools, system=system_instruction, temperature=temperature
+        )
+        model = self._tool_models.get(key)
+        if model is not None:
+            self._tool_models.move_to_end(key)
+            return model
+
+        # ツールをGemini形式に変換
+        function_declarations = []
+
+        if tools:
+            for tool in tools:
+                if "function" in tool:
+                    function_data = tool["function"]
+                    function_declarations.append(
+                        {
+                            "name": function_data.get("name", ""),
+                            "description": function_data.get("description", ""),
+                            "parameters": function_data.get("parameters", {}),
+                        }
+                    )
+
+        model = genai.GenerativeModel(
+            model_name=self.model_name,
+            generation_config={
+                **self.generation_config,
+                **({"temperature": temperature} if temperature is not None else {}),
+            },
+            tools=function_declarations if function_declarations else None,
+            system_instruction=system_instruction,
+        )
+        self._tool_models[key] = model
+        if len(self._tool_models) > self._MODEL_CACHE_SIZE:
+            self._tool_models.popitem(last=False)
+        return model
+
     async def ask_tool(
         self,
         messages: List[Union[dict, Message]],
         system_msgs: Optional[List[Union[dict, Message]]] = None,
         tools: Optional[List[Dict]] = None,
         tool_choice: str = "auto",
+        temperature: Optional[float] = None,
         **kwargs,
     ):
         """
         ツール呼び出し対応のリクエストを実行します
         """
         try:
-            # メッセージの準備
-            formatted_messages = []
-            
-            # システムメッセージが提供されている場合、最初に追加
-            if system_msgs and len(system_msgs) > 0:
-                for sys_msg in system_msgs:
-                    if isinstance(sys_msg, dict):
-                        formatted_messages.append({
-                            "role": "system",
-                            "parts": [{"text": sys_msg.get("content", "")}],
-                        })
-                    elif isinstance(sys_msg, Message):
-                        if sys_msg.role == "system":
-                            formatted_messages.append({
-                                "role": "system",
-                                "parts": [{"text": sys_msg.content}],
-                            })
-            
-            # ユーザーおよびアシスタントメッセージを追加
-            formatted_messages.extend(self.format_messages(messages))
-            
+            # システムメッセージを先頭に、ユーザーおよびアシスタントメッセージを続けて一度に整形
+            api_messages = to_api_messages(messages, system_msgs)
+            (
+                system_instruction,
+                formatted_messages,
+                last_user_message,
+            ) = _to_gemini_messages(api_messages)
+
             # トークン数をチェック
-            self.check_token_limit(formatted_messages)
-            
-            # ツールをGemini形式に変換
-            function_declarations = []
-            
-            if tools:
-                for tool in tools:
-                    if "function" in tool:
-                        function_data = tool["function"]
-                        # paramsが存在するかどうか確認
-                        parameters = {}
-                        if "parameters" in function_data:
-                            parameters = function_data["parameters"]
-                        
-                        function_declarations.append({
-                            "name": function_data.get("name", ""),
-                            "description": function_data.get("description", ""),
-                            "parameters": parameters
-                        })
-            
-            # モデルを初期化（ツール呼び出し対応）
-            model = genai.GenerativeModel(
-                model_name=self.model_name,
-                generation_config=self.generation_config,
-                tools=function_declarations if function_declarations else None
-            )
-            
-            # チャットセッションを作成してメッセージを送信
-            chat = model.start_chat(history=formatted_messages)
-            last_user_message = ""
-            
-            # 最後のユーザーメッセージを取得
-            for msg in reversed(formatted_messages):
-                if msg["role"] == "user":
-                    if "parts" in msg and msg["parts"] and "text" in msg["parts"][0]:
-                        last_user_message = msg["parts"][0]["text"]
-                        break
-            
+            self.check_token_limit(api_messages)
+
+            # ツール定義とシステム指示ごとに生成済みのモデルを再利用（ツール呼び出し対応）
+            model = self._get_tool_model(tools, system_instruction, temperature)
+
+            # 最後のユーザーメッセージは整形時に取得済み
             if not last_user_message:
                 raise ValueError("ユーザーメッセージが見つかりません")
-            
-            # レスポンスを取得
-            response = chat.send_message(last_user_message)
-            
-            # レスポンスからツール呼び出し情報を取得
-            from types import SimpleNamespace
-            result = SimpleNamespace()
-            
-            # テキスト内容の取得
-            result.content = response.text
-            
-            # ツール呼び出しの取得
-            result.tool_calls = []
-            
-            if hasattr(response, "candidates") and response.candidates:
-                for candidate in response.candidates:
-                    if hasattr(candidate, "content") and candidate.content:
-                        content = candidate.content
-                        if hasattr(content, "parts") and content.parts:
-                            for part in content.parts:
-                                if hasattr(part, "function_call") and part.function_call:
-                                    function_call = part.function_call
-                                    result.tool_calls.append({
-                                        "id": f"call_{len(result.tool_calls)}",
-                                        "type": "function",
-                                        "function": {
-                                            "name": function_call.name,
-                                            "arguments": function_call.args
-                                        }
-                                    })
-            
+
+            # 履歴全体（最後のユーザーメッセージを含む）を一度のリクエストで送信
+            async with self._request_semaphore:
+                response = await model.generate_content_async(formatted_messages)
+
+            # レスポンスからテキストとツール呼び出し情報を取得
+            result = ToolResponse(_response_text(response))
+
+            result.tool_calls.extend(
+                {
+                    "id": f"call_{index}",
+                    "type": "function",
+                    "function": {
+                        "name": function_call.name,
+                        # 他プロバイダと同じくJSON文字列で返す（argsはMapComposite）
+                        "arguments": orjson.dumps(
+                            function_call.args, default=_proto_to_builtin
+                        ).decode(),
+                    },
+                }
+                for index, function_call in enumerate(_iter_function_calls(response))
+            )
+
             return result
-                
+
         except Exception as e:
             logger.error(f"Error in Gemini API tool request: {str(e)}")
             raise
-            
-    def check_token_limit(self, messages) -> bool:
+
+    def check_token_limit(self, messages: List[Union[dict, Message]]) -> bool:
         """
         メッセージのトークン数がモデルの制限を超えていないか確認します
         超えている場合はエラーを発生させます
+        messagesはGemini形式ではなくAPI形式（roleとcontent）で渡してください
         """
-        from app.token_counter import TokenCounter
-        
         # プロバイダ名を取得
         provider = "gemini"
-        
-        # トークン数を計算
-        # Gemini形式のメッセージを標準形式に変換する
-        standardized_messages = []
-        for msg in messages:
-            role = msg.get("role", "user")
-            if role == "model":
-                role = "assistant"  # モデルのロールをアシスタントに戻す
-            
-            content = ""
-            if "parts" in msg and msg["parts"] and "text" in msg["parts"][0]:
-                content = msg["parts"][0]["text"]
-                
-            standardized_messages.append({
-                "role": role,
-                "content": content
-            })
-        
-        result = TokenCounter.check_context_limit(standardized_messages, provider)
-        
+
+        # トークン数を計算（制限から十分遠い場合はBPEを使わない見積もりで判定）
+        result = TokenCounter.check_context_limit(messages, provider, approx=True)
+
         if not result["is_within_limit"]:
             logger.warning(
                 f"トークン数が制限を超えています: {result['total_tokens']} > {result['max_tokens']}"
@@ -312,9 +412,9 @@ class GeminiLLM:
                 f"メッセージのトークン数 ({result['total_tokens']}) がGeminiモデルの制限 ({result['max_tokens']}) を超えています。"
                 f"会話を新しいスレッドで開始するか、古いメッセージを削除してください。"
             )
-        
+
         return True
-        
+
     async def process_conversation_thread(
         self,
         thread: "ConversationThread",
@@ -326,11 +426,12 @@ class GeminiLLM:
         """
         会話スレッドに対してリクエストを処理します
         """
-        # メッセージをスレッドに追加
-        thread.add_user_message(user_message)
-        
-        # コンテキスト制限をチェック
-        context_info = thread.check_context_limit()
+        # ユーザーメッセージは応答と合わせてadd_turnで一度に追加する
+        user_msg = Message.user_message(user_message)
+
+        # コンテキスト制限をチェック（未追加のユーザーメッセージを含める）
+        # 使用率が閾値を超えている場合は古いターンを要約して圧縮する
+        context_info = await compact_if_needed(self, thread, [user_msg])
         if not context_info["is_within_limit"]:
             # コンテキスト制限を超えている場合、制限に関する情報をレスポンスとしてアシスタントメッセージを追加
             warning_message = (
@@ -338,24 +439,23 @@ class GeminiLLM:
                 f"現在のトークン数: {context_info['total_tokens']}トークン\n\n"
                 f"新しい会話スレッドを開始することをお勧めします。"
             )
-            thread.add_assistant_message(warning_message)
+            thread.add_turn(user_message, warning_message)
             return warning_message
-        
+
         try:
             # AIモデルに問い合わせ
             response = await self.ask(
-                messages=thread.memory.messages,
+                messages=[*thread.memory.messages, user_msg],
                 system_msgs=system_msgs,
                 stream=stream,
-                temperature=temperature
+                temperature=temperature,
+                # コンテキスト制限は上で確認済み
+                _skip_token_check=True,
             )
-            
-            # レスポンスをスレッドに追加
-            thread.add_assistant_message(response)
-            
-            return response
         except Exception as e:
-            error_message = f"エラーが発生しました: {str(e)}"
-            logger.error(error_message)
-            thread.add_assistant_message(error_message)
-            return error_message 
\ No newline at end of file
+            response = f"エラーが発生しました: {str(e)}"
+            logger.error(response)
+
+        # ユーザーメッセージと応答（またはエラー）をまとめてスレッドに追加
+        thread.add_turn(user_message, response)
+        return response
@@ -1,217 +1,229 @@
+import asyncio
+import io
 import os
-import json
-from typing import Dict, List, Optional, Union
+import threading
+from typing import Dict, List, Optional, Set, Union
+
 from openai import AsyncOpenAI
 
-from app.schema import Message, Function, ConversationThread
+from app.compaction import compact_if_needed
+from app.http_client import create_async_client
 from app.logger import logger
+from app.schema import ConversationThread, Message, ToolResponse, to_api_messages
+from app.stream_writer import StreamWriter
+from app.token_counter import TokenCounter
+
+
+def _summary_indices(
+    messages: List[Union[dict, Message]], formatted_messages: List[Dict]
+) -> Set[int]:
+    """
+    整形済みメッセージのうち、圧縮時の要約メッセージ（is_summary）に対応するインデックスを返す
+    会話メッセージは整形後のリストの末尾に同じ順序で並ぶ
+    """
+    offset = len(formatted_messages) - len(messages)
+    return {
+        offset + index
+        for index, message in enumerate(messages)
+        if getattr(message, "is_summary", False)
+    }
 
 
 class OpenAILLM:
     """
     OpenAIのLLMインターフェース実装クラス
     """
+
     _instance = None
+    _lock = threading.Lock()
 
     def __new__(cls):
+        # スレッドから同時に呼ばれても一つのインスタンスだけを生成する（ダブルチェックロッキング）
         if cls._instance is None:
-            cls._instance = super().__new__(cls)
-            cls._instance._initialized = False
+            with cls._lock:
+                if cls._instance is None:
+                    instance = super().__new__(cls)
+                    instance._initialized = False
+                    cls._instance = instance
         return cls._instance
 
     def __init__(self):
         if self._initialized:
             return
-            
-        # 環境変数から設定を読み込み
-        self.api_key = os.getenv("OPENAI_API_KEY", "")
-        
-        if not self.api_key:
-            raise ValueError("OPENAI_API_KEY環境変数が設定されていません")
-            
-        self.model = os.getenv("OPENAI_MODEL", "o3-mini-2025-01-31")
-        
-        # コンテキストウィンドウサイズを取得
-        self.max_context_tokens = int(os.getenv("OPENAI_MAX_CONTEXT_TOKENS", "200000"))
-        self.max_output_tokens = int(os.getenv("OPENAI_MAX_OUTPUT_TOKENS", "4096"))
-        
-        # OpenAI API Client初期化
-        self.client = AsyncOpenAI(
-            api_key=self.api_key,
-        )
-        
-        self._initialized = True
-        
+        with self._lock:
+            if self._initialized:
+                return
+
+            # 環境変数から設定を読み込み
+            self.api_key = os.getenv("OPENAI_API_KEY", "")
+
+            if not self.api_key:
+                raise ValueError("OPENAI_API_KEY環境変数が設定されていません")
+
+            self.model = os.getenv("OPENAI_MODEL", "o3-mini-2025-01-31")
+
+            # コンテキストウィンドウサイズを取得
+            self.max_context_tokens = int(
+                os.getenv("OPENAI_MAX_CONTEXT_TOKENS", "200000")
+            )
+            self.max_output_tokens = int(os.getenv("OPENAI_MAX_OUTPUT_TOKENS", "4096"))
+
+            # OpenAI API Client初期化
+            # 接続プールを調整したHTTPクライアントを共有し、HTTP/2が使える場合は同時リクエストを多重化する
+            self.client = AsyncOpenAI(
+                api_key=self.api_key,
+                http_client=create_async_client(
+                    timeout=float(os.getenv("OPENAI_REQUEST_TIMEOUT", "600")),
+                    max_connections=200,
+                ),
+            )
+
+            # 同時に送信中のリクエスト数の上限（バースト時のレート制限（429）の連鎖を防ぐ）
+            self._request_semaphore = asyncio.Semaphore(
+                max(1, int(os.getenv("OPENAI_MAX_CONCURRENCY", "16")))
+            )
+
+            self._initialized = True
+
+    async def aclose(self) -> None:
+        """
+        OpenAIクライアントの接続プールを閉じます
+        """
+        await self.client.close()
+
     @staticmethod
     def format_messages(messages: List[Union[dict, Message]]) -> List[Dict]:
         """
         メッセージをOpenAI形式に変換する
         """
-        formatted_messages = []
-        
-        for message in messages:
-            if isinstance(message, dict):
-                formatted_messages.append({
-                    "role": message.get("role", "user"),
-                    "content": message.get("content", "")
-                })
-            elif isinstance(message, Message):
-                formatted_messages.append({
-                    "role": message.role,
-                    "content": message.content
-                })
-            else:
-                raise TypeError(f"Unsupported message type: {type(message)}")
-                
-        return formatted_messages
-        
+        return to_api_messages(messages)
+
     async def ask(
         self,
         messages: List[Union[dict, Message]],
         system_msgs: Optional[List[Union[dict, Message]]] = None,
         stream: bool = False,
         temperature: Optional[float] = None,
+        _skip_token_check: bool = False,
     ) -> str:
         """
         OpenAI APIに問い合わせ、レスポンスを取得する
+        _skip_token_check: 呼び出し側でコンテキスト制限を確認済みの場合にトークン数の再チェックを省略する（内部用）
         """
         try:
-            # メッセージの準備
-            formatted_messages = []
-            
-            # システムメッセージが提供されている場合、最初に追加
-            if system_msgs and len(system_msgs) > 0:
-                for sys_msg in system_msgs:
-                    if isinstance(sys_msg, dict):
-                        formatted_messages.append({
-                            "role": "system",
-                            "content": sys_msg.get("content", "")
-                        })
-                    elif isinstance(sys_msg, Message):
-                        if sys_msg.role == "system":
-                            formatted_messages.append({
-                                "role": "system",
-                                "content": sys_msg.content
-                            })
-            
-            # ユーザーおよびアシスタントメッセージを追加
-            formatted_messages.extend(self.format_messages(messages))
-            
-            # トークン数をチェック
-            self.check_token_limit(formatted_messages)
-            
+            # システムメッセージとユーザーおよびアシスタントメッセージを一度に整形
+            formatted_messages = to_api_messages(messages, system_msgs)
+            # 出力分を残してコンテキストウィンドウに収まるよう、古い履歴から削除する（要約は残す）
+            formatted_messages = TokenCounter.fit_to_window(
+                formatted_messages,
+                "openai",
+                reserve=self.max_output_tokens,
+                pinned=_summary_indices(messages, formatted_messages),
+            )
+
+            # トークン数をチェック（呼び出し側で確認済みの場合は省略）
+            if not _skip_token_check:
+                self.check_token_limit(formatted_messages)
+
             # レスポンスを取得
             if stream:
-                # ストリーミングレスポンスの処理
-                response_stream = await self.client.chat.completions.create(
-                    model=self.model,
-                    messages=formatted_messages,
-                    temperature=0.6 if temperature is None else temperature,
-                    max_tokens=self.max_output_tokens,
-                    top_p=0.95,
-                    stream=True
-                )
-                
-                collected_content = []
-                async for chunk in response_stream:
-                    if chunk.choices and chunk.choices[0].delta.content:
-                        content = chunk.choices[0].delta.content
-                        collected_content.append(content)
-                        print(content, end="", flush=True)
-                
-                print()  # 最後に改行
-                return "".join(collected_content)
+                # ストリーミングレスポンスの処理（ストリームを読み終えるまで同時実行数の枠を保持）
+                async with self._request_semaphore:
+                    response_stream = await self.client.chat.completions.create(
+                        model=self.model,
+                        messages=formatted_messages,
+                        temperature=0.6 if temperature is None else temperature,
+                        max_tokens=self.max_output_tokens,
+                        top_p=0.95,
+                        stream=True,
+                    )
+
+                    collected_content = io.StringIO()
+                    writer = StreamWriter()
+                    async for chunk in response_stream:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            content = chunk.choices[0].delta.content
+                            collected_content.write(content)
+                            writer.write(content)
+
+                writer.close()  # 残りを書き出して改行
+                return collected_content.getvalue()
             else:
                 # 通常レスポンスの処理
-                response = await self.client.chat.completions.create(
-                    model=self.model,
-                    messages=formatted_messages,
-                    temperature=0.6 if temperature is None else temperature,
-                    max_tokens=self.max_output_tokens,
-                    top_p=0.95,
-                    stream=False
-                )
-                
+                async with self._request_semaphore:
+                    response = await self.client.chat.completions.create(
+                        model=self.model,
+                        messages=formatted_messages,
+                        temperature=0.6 if temperature is None else temperature,
+                        max_tokens=self.max_output_tokens,
+                        top_p=0.95,
+                        stream=False,
+                    )
+
                 return response.choices[0].message.content
-                
+
         except Exception as e:
             logger.error(f"Error in OpenAI API request: {str(e)}")
             raise
-    
+
     async def ask_tool(
         self,
         messages: List[Union[dict, Message]],
         system_msgs: Optional[List[Union[dict, Message]]] = None,
         tools: Optional[List[Dict]] = None,
         tool_choice: str = "auto",
+        temperature: Optional[float] = None,
         **kwargs,
     ):
         """
         ツール呼び出し対応のリクエストを実行します
         """
         try:
-            # メッセージの準備
-            formatted_messages = []
-            
-            # システムメッセージが提供されている場合、最初に追加
-            if system_msgs and len(system_msgs) > 0:
-                for sys_msg in system_msgs:
-                    if isinstance(sys_msg, dict):
-                        formatted_messages.append({
-                            "role": "system",
-                            "content": sys_msg.get("content", "")
-                        })
-                    elif isinstance(sys_msg, Message):
-                        if sys_msg.role == "system":
-                            formatted_messages.append({
-                                "role": "system",
-                                "content": sys_msg.content
-                            })
-            
-            # ユーザーおよびアシスタントメッセージを追加
-            formatted_messages.extend(self.format_messages(messages))
-            
+            # システムメッセージとユーザーおよびアシスタントメッセージを一度に整形
+            formatted_messages = to_api_messages(messages, system_msgs)
+            # 出力分を残してコンテキストウィンドウに収まるよう、古い履歴から削除する（要約は残す）
+            formatted_messages = TokenCounter.fit_to_window(
+                formatted_messages,
+                "openai",
+                reserve=self.max_output_tokens,
+                pinned=_summary_indices(messages, formatted_messages),
+            )
+
             # トークン数をチェック
             self.check_token_limit(formatted_messages)
-            
+
             # レスポンス取得
-            response = await self.client.chat.completions.create(
-                model=self.model,
-                messages=formatted_messages,
-                temperature=0.6,
-                max_tokens=self.max_output_tokens,
-                tools=tools,
-                tool_choice=tool_choice if tool_choice != "auto" else "auto"
-            )
-            
+            async with self._request_semaphore:
+                response = await self.client.chat.completions.create(
+                    model=self.model,
+                    messages=formatted_messages,
+                    temperature=0.6 if temperature is None else temperature,
+                    max_tokens=self.max_output_tokens,
+                    tools=tools,
+                    tool_choice=tool_choice if tool_choice != "auto" else "auto",
+                )
+
             # レスポンスからツール呼び出し情報を取得
             message = response.choices[0].message
-            
-            # SimpleNamespaceを使用してレスポンスオブジェクトを作成
-            from types import SimpleNamespace
-            result = SimpleNamespace()
-            result.content = message.content if message.content else ""
-            result.tool_calls = message.tool_calls if hasattr(message, "tool_calls") else []
-            
-            return result
-                
+
+            # 他のプロバイダと同じ軽量なToolResponseで返す
+            return ToolResponse(message.content or "", message.tool_calls)
+
         except Exception as e:
             logger.error(f"Error in OpenAI API tool request: {str(e)}")
             raise
-            
+
     def check_token_limit(self, messages: List[Union[dict, Message]]) -> bool:
         """
         メッセージのトークン数がモデルの制限を超えていないか確認します
         超えている場合はエラーを発生させます
         """
-        from app.token_counter import TokenCounter
-        
         # プロバイダ名を取得
         provider = "openai"
-        
-        # トークン数を計算
-        result = TokenCounter.check_context_limit(messages, provider)
-        
+
+        # トークン数を計算（制限から十分遠い場合はBPEを使わない見積もりで判定）
+        result = TokenCounter.check_context_limit(messages, provider, approx=True)
+
         if not result["is_within_limit"]:
             logger.warning(
                 f"トークン数が制限を超えています: {result['total_tokens']} > {result['max_tokens']}"
@@ -220,9 +232,9 @@ class OpenAILLM:
                 f"メッセージのトークン数 ({result['total_tokens']}) がOpenAIモデルの制限 ({result['max_tokens']}) を超えています。"
                 f"会話を新しいスレッドで開始するか、古いメッセージを削除してください。"
             )
-        
+
         return True
-        
+
     async def process_conversation_thread(
         self,
         thread: "ConversationThread",
@@ -234,11 +246,12 @@ class OpenAILLM:
         """
         会話スレッドに対してリクエストを処理します
         """
-        # メッセージをスレッドに追加
-        thread.add_user_message(user_message)
-        
-        # コンテキスト制限をチェック
-        context_info = thread.check_context_limit()
+        # ユーザーメッセージは応答と合わせてadd_turnで一度に追加する
+        user_msg = Message.user_message(user_message)
+
+        # コンテキスト制限をチェック（未追加のユーザーメッセージを含める）
+        # 使用率が閾値を超えている場合は古いターンを要約して圧縮する
+        context_info = await compact_if_needed(self, thread, [user_msg])
         if not context_info["is_within_limit"]:
             # コンテキスト制限を超えている場合、制限に関する情報をレスポンスとしてアシスタントメッセージを追加
             warning_message = (
@@ -246,24 +259,23 @@ class OpenAILLM:
                 f"現在のトークン数: {context_info['total_tokens']}トークン\n\n"
                 f"新しい会話スレッドを開始することをお勧めします。"
             )
-            thread.add_assistant_message(warning_message)
+            thread.add_turn(user_message, warning_message)
             return warning_message
-        
+
         try:
             # AIモデルに問い合わせ
             response = await self.ask(
-                messages=thread.memory.messages,
+                messages=[*thread.memory.messages, user_msg],
                 system_msgs=system_msgs,
                 stream=stream,
-                temperature=temperature
+                temperature=temperature,
+                # コンテキスト制限は上で確認済み
+                _skip_token_check=True,
             )
-            
-            # レスポンスをスレッドに追加
-            thread.add_assistant_message(response)
-            
-            return response
         except Exception as e:
-            error_message = f"エラーが発生しました: {str(e)}"
-            logger.error(error_message)
-            thread.add_assistant_message(error_message)
-            return error_message 
\ No newline at end of file
+            response = f"エラーが発生しました: {str(e)}"
+            logger.error(response)
+
+        # ユーザーメッセージと応答（またはエラー）をまとめてスレッドに追加
+        thread.add_turn(user_message, response)
+        return response
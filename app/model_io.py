@@ -1,8 +1,103 @@
+import asyncio
 import os
-from typing import List, Optional, Union, Dict, Any
-from app.schema import Message, ModelIORequest, ModelIOResponse, AIProvider, ToolCall, ConversationThread
+import time
+from collections import deque
+from typing import Any, Deque, List, Optional, Tuple, Union
+
+import orjson
+
 from app.llm_factory import LLMFactory
 from app.logger import logger
+from app.schema import (
+    AIProvider,
+    ConversationThread,
+    Message,
+    ModelIORequest,
+    ModelIOResponse,
+    ToolCall,
+)
+from app.token_counter import TokenCounter
+
+
+def _to_tool_call(tool_call: Any) -> ToolCall:
+    """
+    プロバイダのツール呼び出し（OpenAIのオブジェクト、またはGroq・Claude・Gemini形式のdict）をToolCallに変換
+    JSON文字列の引数はorjsonで一度だけ解析する
+    """
+    if isinstance(tool_call, dict):
+        function = tool_call.get("function") or {}
+        call_id, name, arguments = (
+            tool_call.get("id"),
+            function.get("name"),
+            function.get("arguments"),
+        )
+    else:
+        call_id, name, arguments = (
+            tool_call.id,
+            tool_call.function.name,
+            tool_call.function.arguments,
+        )
+    if isinstance(arguments, (str, bytes)):
+        arguments = orjson.loads(arguments or "{}")
+    return ToolCall(id=call_id or "", name=name or "", arguments=arguments or {})
+
+
+def resolve_provider(value: Optional[str] = None) -> AIProvider:
+    """
+    プロバイダ名をAIProviderに変換します
+    未指定の場合は環境変数AI_PROVIDERを参照し、不明な値の場合はOpenAIにフォールバックします
+    """
+    value = (value or os.getenv("AI_PROVIDER", "openai")).lower()
+    try:
+        return AIProvider(value)
+    except ValueError:
+        logger.warning(f"不明なプロバイダ '{value}' が指定されました。OpenAIを使用します。")
+        return AIProvider.OPENAI
+
+
+# 環境変数の参照とEnumの変換はリクエストごとではなく起動時に一度だけ行う
+DEFAULT_PROVIDER = resolve_provider()
+
+
+class _RateLimiter:
+    """
+    直近の一定時間（既定60秒）に送信したリクエスト数とトークン数を追跡し、
+    RPM/TPMの上限を超える場合は枠が空くまで待機させる
+    """
+
+    def __init__(
+        self, rpm: Optional[int] = None, tpm: Optional[int] = None, window: float = 60.0
+    ):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.window = window
+        # (送信時刻, 推定トークン数)
+        self._events: Deque[Tuple[float, int]] = deque()
+        self._tokens = 0
+        # 待機中のリクエストを到着順に通すためのロック
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int) -> None:
+        """
+        tokens分の枠を確保する（上限を超える場合は最も古い送信が期限切れになるまで待機）
+        """
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._events and self._events[0][0] <= now - self.window:
+                    self._tokens -= self._events.popleft()[1]
+                over_rpm = self.rpm is not None and len(self._events) >= self.rpm
+                # 単独で上限を超えるリクエストは、枠が空になった時点で通す
+                over_tpm = (
+                    self.tpm is not None
+                    and bool(self._events)
+                    and self._tokens + tokens > self.tpm
+                )
+                if not (over_rpm or over_tpm):
+                    self._events.append((now, tokens))
+                    self._tokens += tokens
+                    return
+                await asyncio.sleep(self._events[0][0] + self.window - now)
 
 
 class ModelIO:
@@ -10,7 +105,7 @@ class ModelIO:
     異なるAIプロバイダー間で統一されたインターフェースを提供するクラス。
     リクエストとレスポンスを標準化し、適切なLLMインスタンスにルーティングします。
     """
-    
+
     @staticmethod
     async def generate(request: ModelIORequest) -> ModelIOResponse:
         """
@@ -19,11 +114,11 @@ class ModelIO:
         """
         try:
             # リクエストからプロバイダーを決定
-            provider = request.provider or AIProvider(os.getenv("AI_PROVIDER", "openai").lower())
-            
+            provider = request.provider or DEFAULT_PROVIDER
+
             # 適切なLLMインスタンスを取得
             llm = LLMFactory.get_llm(provider)
-            
+
             # ツールが指定されている場合はツール呼び出し用のメソッドを使用
             if request.tools:
                 response = await llm.ask_tool(
@@ -32,24 +127,22 @@ class ModelIO:
                     tools=request.tools,
                     tool_choice=request.tool_choice,
                     stream=request.stream,
-                    temperature=request.temperature
+                    temperature=request.temperature,
                 )
-                
+
                 # レスポンスを標準形式に変換
-                tool_calls = [
-                    ToolCall(
-                        id=tc.id,
-                        name=tc.function.name,
-                        arguments=tc.function.arguments
-                    ) for tc in response.tool_calls
-                ] if hasattr(response, "tool_calls") and response.tool_calls else None
-                
+                tool_calls = (
+                    [_to_tool_call(tc) for tc in response.tool_calls]
+                    if hasattr(response, "tool_calls") and response.tool_calls
+                    else None
+                )
+
                 return ModelIOResponse(
                     content=response.content,
                     tool_calls=tool_calls,
                     usage=getattr(response, "usage", None),
                     provider=provider,
-                    model=os.getenv(f"{provider.upper()}_MODEL", "unknown")
+                    model=os.getenv(f"{provider.upper()}_MODEL", "unknown"),
                 )
             else:
                 # 通常のテキストリクエスト
@@ -57,37 +150,71 @@ class ModelIO:
                     messages=request.messages,
                     system_msgs=request.system_messages,
                     stream=request.stream,
-                    temperature=request.temperature
+                    temperature=request.temperature,
                 )
-                
+
                 return ModelIOResponse(
                     content=content,
                     tool_calls=None,
                     usage=None,
                     provider=provider,
-                    model=os.getenv(f"{provider.upper()}_MODEL", "unknown")
+                    model=os.getenv(f"{provider.upper()}_MODEL", "unknown"),
                 )
-                
+
         except Exception as e:
             logger.error(f"Error in ModelIO.generate: {str(e)}")
             raise
-    
+
+    @staticmethod
+    async def generate_many(
+        requests: List[ModelIORequest],
+        max_concurrent: int = 10,
+        tpm: Optional[int] = None,
+        rpm: Optional[int] = None,
+        return_exceptions: bool = False,
+    ) -> List[Union[ModelIOResponse, BaseException]]:
+        """
+        複数のリクエストを同時実行数の上限付きで並行に送信し、入力と同じ順序でレスポンスを返します
+        tpm/rpmを指定した場合は、直近60秒間の推定入力トークン数・リクエスト数が上限を超えないよう送信を待機させます
+        429などの再試行は各プロバイダのクライアント側で行われます
+        return_exceptions: Trueの場合、失敗したリクエストは例外オブジェクトとして結果に含めます
+        """
+        semaphore = asyncio.Semaphore(max(1, max_concurrent))
+        limiter = _RateLimiter(rpm=rpm, tpm=tpm) if rpm or tpm else None
+
+        async def run(request: ModelIORequest) -> ModelIOResponse:
+            async with semaphore:
+                if limiter is not None:
+                    provider = request.provider or DEFAULT_PROVIDER
+                    tokens = TokenCounter.count_message_tokens(
+                        [*(request.system_messages or ()), *request.messages],
+                        getattr(provider, "value", provider),
+                    )
+                    await limiter.acquire(tokens)
+                return await ModelIO.generate(request)
+
+        return list(
+            await asyncio.gather(
+                *(run(request) for request in requests),
+                return_exceptions=return_exceptions,
+            )
+        )
+
     @staticmethod
     async def quick_ask(query: str, system_prompt: Optional[str] = None) -> str:
         """
         簡単な質問に対して迅速に応答を取得するためのショートカットメソッド
         """
         messages = [Message.user_message(query)]
-        system_messages = [Message.system_message(system_prompt)] if system_prompt else None
-        
-        request = ModelIORequest(
-            messages=messages,
-            system_messages=system_messages
+        system_messages = (
+            [Message.system_message(system_prompt)] if system_prompt else None
         )
-        
+
+        request = ModelIORequest(messages=messages, system_messages=system_messages)
+
         response = await ModelIO.generate(request)
-        return response.content 
-        
+        return response.content
+
     @staticmethod
     async def process_conversation_thread(
         thread: "ConversationThread",
@@ -103,30 +230,32 @@ class ModelIO:
         """
         try:
             # プロバイダーを決定
-            provider = provider or AIProvider(os.getenv("AI_PROVIDER", "openai").lower())
-            
+            provider = provider or DEFAULT_PROVIDER
+
             # 適切なLLMインスタンスを取得
             llm = LLMFactory.get_llm(provider)
-            
+
             # システムメッセージを準備
-            system_messages = [Message.system_message(system_prompt)] if system_prompt else None
-            
+            system_messages = (
+                [Message.system_message(system_prompt)] if system_prompt else None
+            )
+
             # LLMインスタンスを使用して会話スレッドを処理
             response = await llm.process_conversation_thread(
                 thread=thread,
                 user_message=query,
                 system_msgs=system_messages,
                 stream=stream,
-                temperature=temperature
+                temperature=temperature,
             )
-            
+
             return response
-            
+
         except Exception as e:
             error_message = f"Error in conversation thread processing: {str(e)}"
             logger.error(error_message)
-            
+
             # エラーメッセージを会話スレッドに追加
             thread.add_assistant_message(error_message)
-            
-            return error_message 
\ No newline at end of file
+
+            return error_message
@@ -1,9 +1,12 @@
-from enum import Enum
-from typing import Any, List, Literal, Optional, Union, Dict
+import threading
 import uuid
 from datetime import datetime
+from enum import Enum
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Union
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
+
+from app.token_counter import TokenCounter
 
 
 class AgentState(str, Enum):
@@ -24,6 +27,7 @@ class MessageRole(str, Enum):
     """
     メッセージロールの定義
     """
+
     SYSTEM = "system"
     USER = "user"
     ASSISTANT = "assistant"
@@ -34,43 +38,161 @@ class MessageRole(str, Enum):
 class Message(BaseModel):
     """
     LLMとのやり取りに使用されるメッセージの基本スキーマ
+    ターンごとに生成されるため、system_message等のファクトリは文字列のcontentに限り検証を省略して生成する
     """
+
     role: str
     content: str
-    
+    # 古いターンを圧縮した要約メッセージかどうか
+    is_summary: bool = False
+    # アシスタントが要求したツール呼び出し（SDKのツール呼び出しオブジェクト）
+    tool_calls: Optional[List[Any]] = None
+    # ツールの実行結果メッセージが対応するツール呼び出しのIDとツール名
+    tool_call_id: Optional[str] = None
+    name: Optional[str] = None
+
+    @classmethod
+    def _from_role(
+        cls, role: MessageRole, content: Optional[str], **fields: Any
+    ) -> "Message":
+        """
+        contentが文字列の場合は検証を省略してmodel_constructで生成する
+        ツール呼び出しの応答などでNoneの場合は空文字列とし、それ以外の型は通常どおり検証する
+        """
+        if content is None:
+            content = ""
+        if type(content) is str:
+            return cls.model_construct(role=role.value, content=content, **fields)
+        return cls(role=role.value, content=content, **fields)
+
     @classmethod
     def system_message(cls, content: str) -> "Message":
         """
         システムメッセージを作成します
         """
-        return cls(role=MessageRole.SYSTEM, content=content)
-    
+        return cls._from_role(MessageRole.SYSTEM, content)
+
     @classmethod
     def user_message(cls, content: str) -> "Message":
         """
         ユーザーメッセージを作成します
         """
-        return cls(role=MessageRole.USER, content=content)
-    
+        return cls._from_role(MessageRole.USER, content)
+
     @classmethod
     def assistant_message(cls, content: str) -> "Message":
         """
         アシスタントメッセージを作成します
         """
-        return cls(role=MessageRole.ASSISTANT, content=content)
-    
+        return cls._from_role(MessageRole.ASSISTANT, content)
+
     @classmethod
     def function_message(cls, content: str) -> "Message":
         """
         関数メッセージを作成します
         """
-        return cls(role=MessageRole.FUNCTION, content=content)
+        return cls._from_role(MessageRole.FUNCTION, content)
+
+    @classmethod
+    def tool_message(
+        cls, content: str, tool_call_id: str, name: Optional[str] = None
+    ) -> "Message":
+        """
+        ツールの実行結果メッセージを作成します
+        """
+        return cls._from_role(
+            MessageRole.TOOL, content, tool_call_id=tool_call_id, name=name
+        )
+
+    @classmethod
+    def from_tool_calls(
+        cls, tool_calls: List[Any], content: Optional[str] = ""
+    ) -> "Message":
+        """
+        ツール呼び出しを含むアシスタントメッセージを作成します
+        """
+        return cls._from_role(
+            MessageRole.ASSISTANT, content, tool_calls=list(tool_calls)
+        )
+
+
+def _api_message(role: str, content: Any) -> Dict[str, Any]:
+    """
+    API形式のメッセージを生成する
+    プロバイダ側でキャッシュ指定などを付け加えられるよう、呼び出しごとに新しいdictを返す
+    """
+    return {"role": role, "content": content}
+
+
+def _message_to_api(message: Message) -> Dict[str, Any]:
+    """
+    MessageをAPI形式に変換する
+    ツール呼び出しとツールの実行結果の場合は、対応付けに必要なフィールドも含める
+    """
+    formatted = _api_message(message.role, message.content)
+    if message.tool_calls:
+        formatted["tool_calls"] = [
+            call.model_dump() if hasattr(call, "model_dump") else call
+            for call in message.tool_calls
+        ]
+    if message.tool_call_id is not None:
+        formatted["tool_call_id"] = message.tool_call_id
+        if message.name is not None:
+            formatted["name"] = message.name
+    return formatted
+
+
+# メッセージの型ごとのAPI形式（role/content）への変換
+_TO_API_MESSAGE = {
+    dict: lambda m: _api_message(m.get("role", "user"), m.get("content", "")),
+    Message: _message_to_api,
+}
+
+
+def _to_api_message(message: Union[dict, Message]) -> Dict[str, Any]:
+    """
+    メッセージをAPI形式に変換する
+    通常は型で直接変換関数を引き、dictやMessageのサブクラスはisinstanceで基底クラスの変換関数を使う
+    """
+    converter = _TO_API_MESSAGE.get(type(message))
+    if converter is None:
+        for base, candidate in _TO_API_MESSAGE.items():
+            if isinstance(message, base):
+                converter = candidate
+                break
+        else:
+            raise TypeError(f"Unsupported message type: {type(message)}")
+    return converter(message)
+
+
+def to_api_messages(
+    messages: List[Union[dict, Message]],
+    system_msgs: Optional[List[Union[dict, Message]]] = None,
+) -> List[Dict[str, str]]:
+    """
+    システムメッセージと会話メッセージをOpenAI互換のAPI形式のリストに変換
+    dictのシステムメッセージはroleをsystemに揃え、Messageはrole=systemのものだけを採用する
+    """
+    # システムメッセージのリストにそのまま会話メッセージを追加し、中間リストを作らない
+    formatted = [
+        _api_message("system", _to_api_message(m)["content"])
+        for m in system_msgs or ()
+        if isinstance(m, dict)
+        or (isinstance(m, Message) and m.role == MessageRole.SYSTEM)
+    ]
+    # Memoryの履歴のようにMessageだけのリストは、要素ごとの変換関数の引き当てを省く
+    if all(type(m) is Message for m in messages):
+        formatted.extend(_message_to_api(m) for m in messages)
+    else:
+        formatted.extend(_to_api_message(m) for m in messages)
+    return formatted
 
 
 class ToolParameter(BaseModel):
     """
     ツールパラメータの定義
     """
+
     name: str
     description: str
     required: bool = False
@@ -82,15 +204,19 @@ class Tool(BaseModel):
     """
     ツールの定義
     """
+
     name: str
     description: str
-    parameters: Dict[str, Union[ToolParameter, Dict[str, Any]]] = Field(default_factory=dict)
+    parameters: Dict[str, Union[ToolParameter, Dict[str, Any]]] = Field(
+        default_factory=dict
+    )
 
 
 class ToolCall(BaseModel):
     """
     ツール呼び出しの定義
     """
+
     id: str
     name: str
     arguments: Dict[str, Any]
@@ -100,14 +226,29 @@ class ChatResponse(BaseModel):
     """
     チャットレスポンスの標準形式
     """
+
     content: str
     tool_calls: Optional[List[ToolCall]] = None
 
 
+class ToolResponse:
+    """
+    ask_toolの戻り値
+    contentとtool_callsだけを持つ軽量なオブジェクト（インスタンス辞書を持たない）
+    """
+
+    __slots__ = ("content", "tool_calls")
+
+    def __init__(self, content: str, tool_calls: Optional[List[Any]] = None):
+        self.content = content
+        self.tool_calls = tool_calls if tool_calls is not None else []
+
+
 class AIProvider(str, Enum):
     """
     サポートされているAIプロバイダー
     """
+
     OPENAI = "openai"
     GEMINI = "gemini"
     CLAUDE = "claude"
@@ -119,6 +260,7 @@ class ModelIORequest(BaseModel):
     """
     統一されたモデル入力リクエスト形式
     """
+
     messages: List[Message]
     system_messages: Optional[List[Message]] = None
     tools: Optional[List[Tool]] = None
@@ -134,6 +276,7 @@ class ModelIOResponse(BaseModel):
     """
     統一されたモデル出力レスポンス形式
     """
+
     content: str
     tool_calls: Optional[List[ToolCall]] = None
     usage: Optional[Dict[str, int]] = None
@@ -146,85 +289,306 @@ class Memory(BaseModel):
     max_messages: int = Field(default=100)
     provider: Optional[AIProvider] = None
 
+    # API形式に整形済みのメッセージ（messagesと同じ順序で保持）
+    _formatted: List[Dict[str, str]] = PrivateAttr(default_factory=list)
+    # メッセージごとのトークン数とその合計（_token_providerのトークナイザで計算）
+    _token_counts: List[int] = PrivateAttr(default_factory=list)
+    _token_total: int = PrivateAttr(default=0)
+    _token_provider: Optional[str] = PrivateAttr(default=None)
+    # 履歴が変更されるたびに増加するバージョン番号
+    _version: int = PrivateAttr(default=0)
+
+    @property
+    def version(self) -> int:
+        """履歴の変更を検知するためのバージョン番号"""
+        return self._version
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        # messagesが直接代入された場合（BaseAgent.messagesのsetterなど）は件数が同じでも
+        # 内容が変わっている可能性があるため、整形済みメッセージとトークン数を無効化する
+        super().__setattr__(name, value)
+        if name == "messages":
+            self._invalidate_caches()
+
+    def _invalidate_caches(self) -> None:
+        """整形済みメッセージを作り直し、トークン数は次回のget_token_totalで再計算させる"""
+        self._formatted = [_message_to_api(message) for message in self.messages]
+        self._token_counts = []
+        self._token_total = 0
+        self._token_provider = None
+        self._version += 1
+
     def add_message(self, message: Message) -> None:
         """Add a message to memory"""
         self.messages.append(message)
-        # Optional: Implement message limit
-        if len(self.messages) > self.max_messages:
-            self.messages = self.messages[-self.max_messages :]
+        self._formatted.append(_message_to_api(message))
+        self._append_token_count(message)
+        self._version += 1
+        self._enforce_limit()
 
     def add_messages(self, messages: List[Message]) -> None:
         """Add multiple messages to memory"""
         self.messages.extend(messages)
+        self._formatted.extend(_message_to_api(message) for message in messages)
+        for message in messages:
+            self._append_token_count(message)
+        self._version += 1
+        self._enforce_limit()
+
+    def _enforce_limit(self) -> None:
+        """Drop the oldest messages beyond max_messages"""
+        if len(self.messages) > self.max_messages:
+            dropped = len(self.messages) - self.max_messages
+            # キャッシュと位置を揃えるため、messagesは再代入せずにその場で削除する
+            del self.messages[:dropped]
+            del self._formatted[:dropped]
+            if len(self._token_counts) == len(self.messages) + dropped:
+                self._token_total -= sum(self._token_counts[:dropped])
+                del self._token_counts[:dropped]
+            else:
+                self._token_provider = None
 
     def clear(self) -> None:
         """Clear all messages"""
         self.messages.clear()
+        self._formatted.clear()
+        self._token_counts.clear()
+        self._token_total = 0
+        self._version += 1
+
+    def set_messages(self, messages: List[Message]) -> None:
+        """メッセージ履歴を置き換え、整形済みメッセージとトークン数を再計算させる"""
+        # 代入時に__setattr__がキャッシュを無効化する
+        self.messages = list(messages)
+
+    def _provider_name(self) -> str:
+        return self.provider.value if self.provider else "openai"
+
+    def _append_token_count(self, message: Message) -> None:
+        """追加されたメッセージのトークン数だけを累積値に加算"""
+        # プロバイダが変わった場合はget_token_totalで全件を再計算する
+        if self._token_provider != self._provider_name():
+            return
+        count = TokenCounter.count_tokens_for_message(message, self._token_provider)
+        self._token_counts.append(count)
+        self._token_total += count
+
+    def get_token_total(self) -> int:
+        """
+        メッセージ履歴全体のトークン数を取得
+        累積値を使い、プロバイダの変更やmessagesの再代入・リストの直接操作があった場合のみ全件を再計算する
+        """
+        provider_str = self._provider_name()
+        if self._token_provider != provider_str or len(self._token_counts) != len(
+            self.messages
+        ):
+            self._token_provider = provider_str
+            self._token_counts = [
+                TokenCounter.count_tokens_for_message(message, provider_str)
+                for message in self.messages
+            ]
+            self._token_total = sum(self._token_counts)
+        return self._token_total + TokenCounter.REPLY_OVERHEAD_TOKENS
+
+    def drop_oldest(self, target_tokens: int, keep_first_n: int = 0) -> int:
+        """
+        合計トークン数がtarget_tokens以下になるまで古いメッセージから削除し、削除した件数を返す
+        最初のkeep_first_n件・要約メッセージ（is_summary）・最後のメッセージは削除しない
+        ユーザーとアシスタントの組が崩れないよう、先頭に残ったアシスタントメッセージも合わせて削除する
+        """
+        total = self.get_token_total()
+        if total <= target_tokens:
+            return 0
+        dropped = set()
+        for index in range(keep_first_n, len(self.messages) - 1):
+            message = self.messages[index]
+            if message.is_summary:
+                continue
+            if total <= target_tokens and message.role != MessageRole.ASSISTANT:
+                break
+            dropped.add(index)
+            total -= self._token_counts[index]
+        if dropped:
+            self.set_messages(
+                [
+                    message
+                    for index, message in enumerate(self.messages)
+                    if index not in dropped
+                ]
+            )
+        return len(dropped)
 
     def get_recent_messages(self, n: int) -> List[Message]:
         """Get n most recent messages"""
         return self.messages[-n:]
 
+    def get_formatted_messages(self) -> List[Dict[str, str]]:
+        """
+        API形式に整形済みのメッセージを取得
+        messagesのリストが直接操作されて件数がずれた場合は全件を再整形する
+        """
+        if len(self._formatted) != len(self.messages):
+            self._formatted = [_message_to_api(message) for message in self.messages]
+        return self._formatted
+
     def to_dict_list(self) -> List[dict]:
         """Convert messages to list of dicts"""
-        return [msg.dict() for msg in self.messages]
-    
-    def check_context_limit(self) -> Dict:
+        # フィールドはフラットなため、model_dumpのシリアライズを経由せずに同じ形のdictを直接組み立てる
+        return [
+            {"role": msg.role, "content": msg.content, "is_summary": msg.is_summary}
+            for msg in self.messages
+        ]
+
+    def check_context_limit(
+        self, pending_messages: Optional[List[Message]] = None
+    ) -> Dict:
         """
         現在のメッセージ履歴がコンテキストウィンドウ制限を超えているかチェック
+        pending_messagesが与えられた場合は、未追加のメッセージを含めた合計で判定する
         """
-        from app.token_counter import TokenCounter
-        
-        provider_str = self.provider.value if self.provider else "openai"
-        return TokenCounter.check_context_limit(self.messages, provider_str)
+        provider_str = self._provider_name()
+        total_tokens = self.get_token_total()
+        if pending_messages:
+            total_tokens += sum(
+                TokenCounter.count_tokens_for_message(message, provider_str)
+                for message in pending_messages
+            )
+        return TokenCounter.check_context_limit(
+            self.messages, provider_str, total_tokens=total_tokens
+        )
 
 
 class ConversationThread(BaseModel):
     """
     会話スレッドを管理するためのクラス
     """
+
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     title: str = Field(default="New Conversation")
     memory: Memory = Field(default_factory=Memory)
     created_at: datetime = Field(default_factory=datetime.now)
     updated_at: datetime = Field(default_factory=datetime.now)
     provider: Optional[AIProvider] = None
-    
+
+    # 直近のコンテキスト情報と、その計算時点の(履歴バージョン, プロバイダ)
+    _last_context_info: Optional[Dict] = PrivateAttr(default=None)
+    _context_info_key: Optional[tuple] = PrivateAttr(default=None)
+    # 複数ユーザーから同じスレッドに書き込まれる場合の排他制御
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
     def add_message(self, message: Message) -> None:
         """メッセージを追加"""
-        self.memory.add_message(message)
-        self.updated_at = datetime.now()
-    
+        with self._lock:
+            self.memory.add_message(message)
+            self.updated_at = datetime.now()
+
+    def add_turn(self, user_content: str, assistant_content: str) -> None:
+        """ユーザーメッセージとアシスタントの応答を1回の操作でまとめて追加"""
+        with self._lock:
+            self.memory.add_messages(
+                [
+                    Message.user_message(user_content),
+                    Message.assistant_message(assistant_content),
+                ]
+            )
+            self.updated_at = datetime.now()
+
     def add_user_message(self, content: str) -> None:
         """ユーザーメッセージを追加"""
         self.add_message(Message.user_message(content))
-    
+
     def add_assistant_message(self, content: str) -> None:
         """アシスタントメッセージを追加"""
         self.add_message(Message.assistant_message(content))
-    
+
     def add_system_message(self, content: str) -> None:
         """システムメッセージを追加"""
         self.add_message(Message.system_message(content))
-    
-    def check_context_limit(self) -> Dict:
+
+    def check_context_limit(
+        self, pending_messages: Optional[List[Message]] = None
+    ) -> Dict:
         """
         現在のスレッドがコンテキストウィンドウ制限を超えているかチェック
+        pending_messagesが与えられた場合は、未追加のメッセージを含めて判定する
         """
         if self.provider and self.memory.provider != self.provider:
             self.memory.provider = self.provider
-            
-        return self.memory.check_context_limit()
+
+        if pending_messages:
+            return self.memory.check_context_limit(pending_messages)
+
+        # 履歴もプロバイダも変わっていなければ前回の結果を再利用
+        key = (self.memory.version, self.memory.provider)
+        if self._last_context_info is None or self._context_info_key != key:
+            self._last_context_info = self.memory.check_context_limit()
+            self._context_info_key = key
+        return self._last_context_info
+
+    def drop_oldest_turns(self, target_tokens: int, keep_first_n: int = 0) -> int:
+        """
+        要約後もコンテキストに収まらない場合のスライディングウィンドウ
+        合計トークン数がtarget_tokens以下になるまで古いターンを削除し、削除した件数を返す
+        """
+        with self._lock:
+            dropped = self.memory.drop_oldest(target_tokens, keep_first_n=keep_first_n)
+            if dropped:
+                self.updated_at = datetime.now()
+        return dropped
+
+    async def compact(
+        self,
+        summarize: Callable[[List[Message]], Awaitable[str]],
+        keep_recent: int = 20,
+        keep_first_n: int = 0,
+    ) -> bool:
+        """
+        古いターンを1つの要約メッセージ（is_summary=True）に置き換えてスレッドを圧縮
+        最初のkeep_first_n件と直近のkeep_recent件はそのまま保持する
+        以前の要約は要約対象に含まれるため、要約済みの区間を個別に再要約することはない
+        要約中に他から履歴が置き換えられた場合は何もせずFalseを返す
+        """
+        snapshot = list(self.memory.messages)
+        middle = snapshot[keep_first_n : len(snapshot) - keep_recent]
+        # 圧縮対象がない、または既存の要約1件だけの場合は何もしない
+        if not middle or (len(middle) == 1 and middle[0].is_summary):
+            return False
+
+        summary = await summarize(middle)
+        summary_message = Message(
+            role=MessageRole.ASSISTANT,
+            content=f"Summary of earlier conversation:\n{summary}",
+            is_summary=True,
+        )
+
+        with self._lock:
+            current = self.memory.messages
+            if current[: len(snapshot)] != snapshot:
+                return False
+            # 要約中に追加されたメッセージは末尾に残す
+            self.memory.set_messages(
+                [
+                    *snapshot[:keep_first_n],
+                    summary_message,
+                    *snapshot[len(snapshot) - keep_recent :],
+                    *current[len(snapshot) :],
+                ]
+            )
+            self.updated_at = datetime.now()
+        return True
 
 
 class ConversationManager(BaseModel):
     """
     複数の会話スレッドを管理するためのクラス
     """
+
     threads: Dict[str, ConversationThread] = Field(default_factory=dict)
     current_thread_id: Optional[str] = None
-    
-    def create_thread(self, provider: Optional[AIProvider] = None, title: Optional[str] = None) -> ConversationThread:
+
+    def create_thread(
+        self, provider: Optional[AIProvider] = None, title: Optional[str] = None
+    ) -> ConversationThread:
         """新しいスレッドを作成"""
         thread = ConversationThread(provider=provider)
         if title:
@@ -232,26 +596,28 @@ class ConversationManager(BaseModel):
         self.threads[thread.id] = thread
         self.current_thread_id = thread.id
         return thread
-    
-    def get_thread(self, thread_id: Optional[str] = None) -> Optional[ConversationThread]:
+
+    def get_thread(
+        self, thread_id: Optional[str] = None
+    ) -> Optional[ConversationThread]:
         """スレッドを取得"""
         if thread_id:
             return self.threads.get(thread_id)
         elif self.current_thread_id:
             return self.threads.get(self.current_thread_id)
         return None
-    
+
     def get_current_thread(self) -> Optional[ConversationThread]:
         """現在のスレッドを取得"""
         return self.get_thread()
-    
+
     def set_current_thread(self, thread_id: str) -> bool:
         """現在のスレッドを設定"""
         if thread_id in self.threads:
             self.current_thread_id = thread_id
             return True
         return False
-    
+
     def delete_thread(self, thread_id: str) -> bool:
         """スレッドを削除"""
         if thread_id in self.threads:
@@ -260,21 +626,23 @@ class ConversationManager(BaseModel):
             del self.threads[thread_id]
             return True
         return False
-        
+
+    @staticmethod
+    def get_thread_info(thread: ConversationThread) -> Dict[str, Union[str, datetime]]:
+        """スレッドの基本情報を取得"""
+        return {
+            "id": thread.id,
+            "title": thread.title,
+            "created_at": thread.created_at,
+            "updated_at": thread.updated_at,
+            "provider": thread.provider.value if thread.provider else None,
+            "message_count": len(thread.memory.messages),
+        }
+
     def list_threads(self) -> List[Dict[str, Union[str, datetime]]]:
         """全スレッドの情報をリスト形式で取得"""
-        return [
-            {
-                "id": thread.id,
-                "title": thread.title,
-                "created_at": thread.created_at,
-                "updated_at": thread.updated_at,
-                "provider": thread.provider.value if thread.provider else None,
-                "message_count": len(thread.memory.messages)
-            }
-            for thread in self.threads.values()
-        ]
-    
+        return [self.get_thread_info(thread) for thread in self.threads.values()]
+
     def rename_thread(self, thread_id: str, new_title: str) -> bool:
         """スレッドの名前を変更"""
         thread = self.get_thread(thread_id)
@@ -283,7 +651,7 @@ class ConversationManager(BaseModel):
             thread.updated_at = datetime.now()
             return True
         return False
-    
+
     def clear_thread(self, thread_id: str) -> bool:
         """スレッドの会話履歴をクリア"""
         thread = self.get_thread(thread_id)
@@ -292,14 +660,14 @@ class ConversationManager(BaseModel):
             thread.updated_at = datetime.now()
             return True
         return False
-    
+
     def ensure_current_thread(self) -> ConversationThread:
         """現在のスレッドを取得、なければ作成"""
         current = self.get_current_thread()
         if not current:
             return self.create_thread()
         return current
-    
+
     def get_thread_context_info(self, thread_id: Optional[str] = None) -> Dict:
         """スレッドのコンテキスト情報を取得"""
         thread = self.get_thread(thread_id)
@@ -309,9 +677,9 @@ class ConversationManager(BaseModel):
                 "message_count": 0,
                 "is_within_limit": True,
                 "total_tokens": 0,
-                "max_tokens": 0
+                "max_tokens": 0,
             }
-        
+
         context_info = thread.check_context_limit()
         return {
             "exists": True,
@@ -319,5 +687,9 @@ class ConversationManager(BaseModel):
             "is_within_limit": context_info["is_within_limit"],
             "total_tokens": context_info["total_tokens"],
             "max_tokens": context_info["max_tokens"],
-            "usage_percentage": int((context_info["total_tokens"] / context_info["max_tokens"]) * 100) if context_info["max_tokens"] > 0 else 0
+            "usage_percentage": int(
+                (context_info["total_tokens"] / context_info["max_tokens"]) * 100
+            )
+            if context_info["max_tokens"] > 0
+            else 0,
         }
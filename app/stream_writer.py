@@ -0,0 +1,74 @@
+import os
+import sys
+import time
+from typing import List, Optional
+
+
+def stream_echo_enabled() -> bool:
+    """
+    ストリーミング時にトークンを標準出力へエコーするか（環境変数LLM_STREAM_ECHO）
+    """
+    return os.getenv("LLM_STREAM_ECHO", "true").lower() in ("1", "true", "yes")
+
+
+class StreamWriter:
+    """
+    ストリーミングのトークンをバッファリングして標準出力へ書き出すライター
+    トークンごとにflushせず、一定の文字数または時間ごとにまとめて書き出す
+    """
+
+    def __init__(
+        self,
+        enabled: Optional[bool] = None,
+        max_chars: Optional[int] = None,
+        max_interval: Optional[float] = None,
+    ):
+        self.enabled = stream_echo_enabled() if enabled is None else enabled
+        # 書き出しの閾値（環境変数LLM_STREAM_FLUSH_CHARS / LLM_STREAM_FLUSH_MSで調整可能）
+        self.max_chars = (
+            int(os.getenv("LLM_STREAM_FLUSH_CHARS", "256"))
+            if max_chars is None
+            else max_chars
+        )
+        self.max_interval = (
+            float(os.getenv("LLM_STREAM_FLUSH_MS", "25")) / 1000
+            if max_interval is None
+            else max_interval
+        )
+        self._buffer: List[str] = []
+        self._buffered_chars = 0
+        self._last_flush = time.monotonic()
+
+    def write(self, text: str) -> None:
+        """
+        テキストをバッファに追加し、閾値を超えたら書き出す
+        """
+        if not self.enabled:
+            return
+        self._buffer.append(text)
+        self._buffered_chars += len(text)
+        if (
+            self._buffered_chars >= self.max_chars
+            or time.monotonic() - self._last_flush > self.max_interval
+        ):
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        バッファの内容を書き出す
+        """
+        if self._buffer:
+            sys.stdout.write("".join(self._buffer))
+            sys.stdout.flush()
+            self._buffer.clear()
+            self._buffered_chars = 0
+        self._last_flush = time.monotonic()
+
+    def close(self) -> None:
+        """
+        残りのバッファを書き出し、最後に改行する
+        """
+        if not self.enabled:
+            return
+        self._buffer.append("\n")
+        self.flush()
@@ -1,40 +1,125 @@
+import functools
 import os
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple, Union
+
 import tiktoken
-from typing import Dict, List, Union, Optional
 
-from app.schema import Message
 from app.logger import logger
 
 
+if TYPE_CHECKING:
+    # app.schemaは実行時にこのモジュールをインポートするため、型注釈のためだけに参照する
+    from app.schema import Message
+
+
+@functools.lru_cache(maxsize=8)
+def _load_encoding(encoding_name: str) -> tiktoken.Encoding:
+    """エンコーディングをロード（エンコーディング名ごとに一度だけ）"""
+    return tiktoken.get_encoding(encoding_name)
+
+
+# 全プロバイダで共通のエンコーディング（Claude・Gemini・Llama系も近似としてcl100k_baseを使用）
+# BPEファイルの読み込みを伴うため、エンコーディング本体は初回のエンコード時にロードする
+_ENCODING_NAME = "cl100k_base"
+
+
+# (エンコーディング名, テキスト) -> トークン数（同一テキストの再エンコードを避けるためのメモ）
+_TEXT_TOKEN_COUNTS: "OrderedDict[Tuple[str, str], int]" = OrderedDict()
+_TEXT_TOKEN_CACHE_SIZE = 16384
+# 未計測のテキストがこの件数以上ある場合はencode_batchでまとめてエンコードする
+_BATCH_ENCODE_THRESHOLD = 8
+
+
+def _remember_text_tokens(key: Tuple[str, str], count: int) -> None:
+    """トークン数をメモし、上限を超えた古いエントリを破棄"""
+    _TEXT_TOKEN_COUNTS[key] = count
+    while len(_TEXT_TOKEN_COUNTS) > _TEXT_TOKEN_CACHE_SIZE:
+        _TEXT_TOKEN_COUNTS.popitem(last=False)
+
+
+def _count_text_tokens(text: str, encoding_name: str) -> int:
+    """同一テキストの再エンコードを避けるため、トークン数をメモ化"""
+    key = (encoding_name, text)
+    count = _TEXT_TOKEN_COUNTS.get(key)
+    if count is None:
+        count = len(_load_encoding(encoding_name).encode(text))
+        _remember_text_tokens(key, count)
+    return count
+
+
+@functools.lru_cache(maxsize=512)
+def _count_contents_tokens(
+    contents: tuple, encoding_name: str, message_overhead: int
+) -> int:
+    """
+    メッセージ内容の並びごとのトークン数をメモ化（リトライや同一履歴の再チェックは一度のルックアップで済む）
+    各メッセージのトークン数はメモを使うため、新しいメッセージだけがエンコードされる
+    読み込んだ履歴など未計測のテキストが多い場合は、encode_batchでまとめて並列にエンコードする
+    """
+    missing = [
+        content
+        for content in set(contents)
+        if content and (encoding_name, content) not in _TEXT_TOKEN_COUNTS
+    ]
+    if len(missing) >= _BATCH_ENCODE_THRESHOLD:
+        encoded = _load_encoding(encoding_name).encode_batch(missing)
+        for content, tokens in zip(missing, encoded):
+            _remember_text_tokens((encoding_name, content), len(tokens))
+    return sum(
+        message_overhead
+        + (_count_text_tokens(content, encoding_name) if content else 0)
+        for content in contents
+    )
+
+
+def _message_contents(messages: List[Union[Dict, "Message"]]) -> List[str]:
+    """
+    メッセージを共通形式（内容の文字列）に変換
+    文字列以外（リスト形式など）の内容は数えないため空文字列にする
+    """
+    contents = []
+    for message in messages:
+        if isinstance(message, dict):
+            content = message.get("content", "")
+        elif hasattr(message, "content"):
+            content = message.content
+        else:
+            logger.warning(f"サポートされていないメッセージ型: {type(message)}")
+            continue
+        contents.append(content if isinstance(content, str) else "")
+    return contents
+
+
 class TokenCounter:
     """
     各種LLMモデルのトークン数をカウントするユーティリティクラス
     """
-    
-    # デフォルトエンコーディング
-    _DEFAULT_ENCODING = "cl100k_base"  # OpenAIモデル用のデフォルトエンコーディング
-    
-    # 各プロバイダのエンコーディングマッピング
-    _ENCODING_MAP = {
-        "openai": "cl100k_base",       # OpenAI GPT系列
-        "claude": "cl100k_base",       # Claude系列も同様のエンコーディングを使用
-        "gemini": "cl100k_base",       # Geminiは正確には異なるが近似として使用
-        "groq_llama": "cl100k_base",   # Llama系
-        "groq_deepseek": "cl100k_base" # DeepSeek系
-    }
-    
+
+    # メッセージごとのフォーマットオーバーヘッド（概算）
+    MESSAGE_OVERHEAD_TOKENS = 4
+    # メッセージ全体に追加されるフォーマットトークン（終了トークンなど）
+    REPLY_OVERHEAD_TOKENS = 2
+
     @classmethod
     def get_encoding(cls, provider: str) -> tiktoken.Encoding:
         """
-        プロバイダに基づいてエンコーディングを取得
+        エンコーディングを取得（全プロバイダ共通。後方互換のためproviderを受け取る）
+        """
+        return _load_encoding(_ENCODING_NAME)
+
+    @classmethod
+    def warmup(cls) -> None:
+        """
+        エンコーディング（BPEランクと正規表現）を事前にロードする
+        初回リクエスト内でロードの待ち時間が発生しないよう、起動時に呼び出す
         """
-        encoding_name = cls._ENCODING_MAP.get(provider, cls._DEFAULT_ENCODING)
         try:
-            return tiktoken.get_encoding(encoding_name)
+            _load_encoding(_ENCODING_NAME).encode("warmup")
         except Exception as e:
-            logger.error(f"エンコーディング取得エラー: {str(e)}")
-            return tiktoken.get_encoding(cls._DEFAULT_ENCODING)
-    
+            # ロードに失敗しても初回のカウント時に再試行されるため、起動は続行する
+            logger.warning(f"エンコーディングの事前ロードに失敗しました: {str(e)}")
+
     @classmethod
     def count_tokens(cls, text: str, provider: str = "openai") -> int:
         """
@@ -42,72 +127,170 @@ class TokenCounter:
         """
         if not text:
             return 0
-            
-        encoding = cls.get_encoding(provider)
-        return len(encoding.encode(text))
-    
+
+        return _count_text_tokens(text, _ENCODING_NAME)
+
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        """
+        BPEを使わずにトークン数の上限を見積もる
+        各トークンは1バイト以上に対応するため、UTF-8のバイト数（ASCIIなら文字数）を超えない
+        """
+        if not text:
+            return 0
+        return len(text) if text.isascii() else len(text.encode("utf-8"))
+
+    @classmethod
+    def count_tokens_for_message(
+        cls, message: Union[Dict, "Message"], provider: str = "openai"
+    ) -> int:
+        """
+        単一メッセージのトークン数をカウント（ロールごとのオーバーヘッドを含む）
+        """
+        if isinstance(message, dict):
+            content = message.get("content", "")
+        elif hasattr(message, "content"):
+            content = message.content
+        else:
+            logger.warning(f"サポートされていないメッセージ型: {type(message)}")
+            return 0
+
+        # 内容のトークン数はテキスト単位でメモ化されるため、変更のない履歴は再エンコードしない
+        # 文字列以外（リスト形式など）はキャッシュのキーにできないため、オーバーヘッドのみ加算する
+        if not isinstance(content, str):
+            return cls.MESSAGE_OVERHEAD_TOKENS
+        return cls.MESSAGE_OVERHEAD_TOKENS + cls.count_tokens(content, provider)
+
     @classmethod
-    def count_message_tokens(cls, 
-                            messages: List[Union[Dict, Message]], 
-                            provider: str = "openai") -> int:
+    def count_message_tokens(
+        cls, messages: List[Union[Dict, "Message"]], provider: str = "openai"
+    ) -> int:
         """
         メッセージリストのトークン数をカウント
         """
-        token_count = 0
-        encoding = cls.get_encoding(provider)
-        
-        # メッセージごとに処理
-        for message in messages:
-            # メッセージを共通形式に変換
-            if isinstance(message, dict):
-                role = message.get("role", "user")
-                content = message.get("content", "")
-            elif isinstance(message, Message):
-                role = message.role
-                content = message.content
-            else:
-                logger.warning(f"サポートされていないメッセージ型: {type(message)}")
-                continue
-                
-            # ベースとなるトークン数を追加（ロールごとに追加される分）
-            token_count += 4  # メッセージフォーマットのオーバーヘッド（概算）
-            
-            # コンテンツのトークン数を追加
-            token_count += len(encoding.encode(content))
-        
-        # メッセージ全体に追加されるフォーマットトークン
-        token_count += 2  # 終了トークンなど
-        
-        return token_count
-    
+        contents = _message_contents(messages)
+
+        # メッセージごとのオーバーヘッドと内容のトークン数、およびメッセージ全体に追加されるフォーマットトークン
+        return (
+            _count_contents_tokens(
+                tuple(contents), _ENCODING_NAME, cls.MESSAGE_OVERHEAD_TOKENS
+            )
+            + cls.REPLY_OVERHEAD_TOKENS
+        )
+
+    @classmethod
+    def estimate_message_tokens(cls, messages: List[Union[Dict, "Message"]]) -> int:
+        """
+        メッセージリストのトークン数の上限をBPEを使わずに見積もる（オーバーヘッドを含む）
+        """
+        return (
+            sum(
+                cls.MESSAGE_OVERHEAD_TOKENS + cls.estimate_tokens(content)
+                for content in _message_contents(messages)
+            )
+            + cls.REPLY_OVERHEAD_TOKENS
+        )
+
     @classmethod
-    def check_context_limit(cls, 
-                           messages: List[Union[Dict, Message]], 
-                           provider: str = "openai") -> Dict:
+    def check_context_limit(
+        cls,
+        messages: List[Union[Dict, "Message"]],
+        provider: str = "openai",
+        total_tokens: Optional[int] = None,
+        approx: bool = False,
+    ) -> Dict:
         """
         メッセージリストがコンテキストウィンドウ制限を超えているかチェック
+        total_tokensが与えられた場合は再カウントせずにその値を使用
+        approx=Trueの場合、上限の見積もりが制限内に収まればBPEによるカウントを省略する
+        （このときtotal_tokensは見積もり値。制限付近では正確にカウントする）
         戻り値: {"is_within_limit": bool, "total_tokens": int, "max_tokens": int, "remaining_tokens": int}
         """
         # プロバイダに基づいて最大トークン数を取得
         max_tokens = cls.get_max_context_tokens(provider)
-        
+
+        # 制限から十分遠い場合は見積もりで判定する（見積もりは実際のトークン数を下回らない）
+        if total_tokens is None and approx:
+            estimated = cls.estimate_message_tokens(messages)
+            if estimated <= max_tokens:
+                total_tokens = estimated
+
         # メッセージのトークン数を計算
-        total_tokens = cls.count_message_tokens(messages, provider)
-        
+        if total_tokens is None:
+            total_tokens = cls.count_message_tokens(messages, provider)
+
         # 残りのトークン数を計算
         remaining_tokens = max_tokens - total_tokens
-        
+
         return {
             "is_within_limit": total_tokens <= max_tokens,
             "total_tokens": total_tokens,
             "max_tokens": max_tokens,
-            "remaining_tokens": remaining_tokens
+            "remaining_tokens": remaining_tokens,
         }
-    
+
+    @classmethod
+    def fit_to_window(
+        cls,
+        messages: List[Dict],
+        provider: str = "openai",
+        reserve: Optional[int] = None,
+        pinned: Optional[Set[int]] = None,
+    ) -> List[Dict]:
+        """
+        API形式のメッセージがコンテキストウィンドウ（出力用にreserveトークンを確保）に収まるよう、
+        システムメッセージと最後のメッセージを残して古いメッセージから削除したリストを返す
+        pinnedに含まれるインデックスのメッセージ（圧縮時の要約など）も削除しない
+        ユーザーとアシスタントの組が崩れないよう、先頭に残ったアシスタントメッセージも合わせて削除する
+        収まっている場合は元のリストをそのまま返す
+        """
+        if reserve is None:
+            reserve = cls.get_max_output_tokens(provider)
+        budget = cls.get_max_context_tokens(provider) - reserve
+
+        # 上限の見積もりが収まる場合はBPEによるカウントを省略する
+        if cls.estimate_message_tokens(messages) <= budget:
+            return messages
+
+        counts = [
+            cls.count_tokens_for_message(message, provider) for message in messages
+        ]
+        total = sum(counts) + cls.REPLY_OVERHEAD_TOKENS
+        if total <= budget:
+            return messages
+
+        # 削除候補はシステムメッセージと固定されたメッセージ以外（最後のメッセージは現在の問い合わせのため残す）
+        pinned = pinned or set()
+        candidates = [
+            index
+            for index, message in enumerate(messages[:-1])
+            if message.get("role") != "system" and index not in pinned
+        ]
+        dropped = set()
+        for index in candidates:
+            if total <= budget:
+                # 残りの履歴がアシスタントメッセージから始まる場合は組ごと削除する
+                if messages[index].get("role") != "assistant":
+                    break
+            dropped.add(index)
+            total -= counts[index]
+
+        if not dropped:
+            return messages
+        logger.info(
+            f"コンテキストウィンドウに収めるため古いメッセージを{len(dropped)}件削除しました "
+            f"(残りのトークン数: {total} / {budget})"
+        )
+        return [
+            message for index, message in enumerate(messages) if index not in dropped
+        ]
+
     @staticmethod
+    @functools.lru_cache(maxsize=16)
     def get_max_context_tokens(provider: str) -> int:
         """
         プロバイダに基づいて最大コンテキストウィンドウトークン数を取得
+        リクエストごとのチェックで環境変数を再解析しないよう、プロバイダごとにメモ化
         """
         # 環境変数から各プロバイダの最大トークン数を取得
         if provider == "openai":
@@ -121,11 +304,12 @@ class TokenCounter:
         else:
             # デフォルト値
             return 16000
-    
+
     @staticmethod
+    @functools.lru_cache(maxsize=16)
     def get_max_output_tokens(provider: str) -> int:
         """
-        プロバイダに基づいて最大出力トークン数を取得
+        プロバイダに基づいて最大出力トークン数を取得（プロバイダごとにメモ化）
         """
         # 環境変数から各プロバイダの最大出力トークン数を取得
         if provider == "openai":
@@ -138,4 +322,4 @@ class TokenCounter:
             return int(os.getenv("GROQ_MAX_OUTPUT_TOKENS", "4096"))
         else:
             # デフォルト値
-            return 4096 
\ No newline at end of file
+            return 4096
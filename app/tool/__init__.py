@@ -1,6 +1,7 @@
 from app.tool.base import BaseTool
 from app.tool.bash import Bash
 from app.tool.create_chat_completion import CreateChatCompletion
+from app.tool.fetch_tool_result import FetchToolResult
 from app.tool.planning import PlanningTool
 from app.tool.str_replace_editor import StrReplaceEditor
 from app.tool.terminate import Terminate
@@ -14,5 +15,6 @@ __all__ = [
     "StrReplaceEditor",
     "ToolCollection",
     "CreateChatCompletion",
+    "FetchToolResult",
     "PlanningTool",
 ]
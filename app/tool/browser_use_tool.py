@@ -1,7 +1,7 @@
 import asyncio
-import json
 from typing import Optional
 
+import orjson
 from browser_use import Browser as BrowserUseBrowser
 from browser_use import BrowserConfig
 from browser_use.browser.context import BrowserContext
@@ -241,7 +241,7 @@ class BrowserUseTool(BaseTool):
                     "tabs": [tab.model_dump() for tab in state.tabs],
                     "interactive_elements": state.element_tree.clickable_elements_to_string(),
                 }
-                return ToolResult(output=json.dumps(state_info))
+                return ToolResult(output=orjson.dumps(state_info).decode())
             except Exception as e:
                 return ToolResult(error=f"Failed to get browser state: {str(e)}")
 
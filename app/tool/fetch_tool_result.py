@@ -0,0 +1,35 @@
+from typing import Dict
+
+from pydantic import Field
+
+from app.tool.base import BaseTool
+
+
+_FETCH_TOOL_RESULT_DESCRIPTION = """Retrieve the full content of an earlier tool result that was replaced by a [tool_result_ref:...] placeholder to save context.
+Use this tool only when the summary shown in the placeholder is not enough to continue the task.
+"""
+
+
+class FetchToolResult(BaseTool):
+    name: str = "fetch_tool_result"
+    description: str = _FETCH_TOOL_RESULT_DESCRIPTION
+    parameters: dict = {
+        "type": "object",
+        "properties": {
+            "ref": {
+                "type": "string",
+                "description": "(required) The reference id shown in the [tool_result_ref:...] placeholder.",
+            },
+        },
+        "required": ["ref"],
+    }
+
+    # 履歴から退避したツール結果の本体（参照ID -> 内容）
+    store: Dict[str, str] = Field(default_factory=dict)
+
+    async def execute(self, ref: str) -> str:
+        """Return the stored tool result for the given reference id"""
+        content = self.store.get(ref)
+        if content is None:
+            return f"Error: No stored tool result found for reference '{ref}'"
+        return content
@@ -4,9 +4,13 @@ from app.agent.manus import Manus
 from app.flow.base import FlowType
 from app.flow.flow_factory import FlowFactory
 from app.logger import logger
+from app.token_counter import TokenCounter
 
 
 async def run_flow():
+    # トークナイザを事前にロードし、初回リクエストでの待ち時間をなくす
+    TokenCounter.warmup()
+
     agents = {
         "manus": Manus(),
     }
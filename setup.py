@@ -33,7 +33,14 @@ setup(
         "aiofiles~=24.1.0",
         "pydantic_core~=2.27.2",
         "colorama~=0.4.6",
+        "h2~=4.1.0",
+        "orjson~=3.10.15",
+        "anthropic~=0.42.0",
     ],
+    extras_require={
+        # 意味的キャッシュ（環境変数LLM_SEMANTIC_CACHE=trueで有効化）
+        "semantic-cache": ["sentence-transformers~=3.4.1"],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "Programming Language :: Python :: 3.12",